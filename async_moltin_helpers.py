@@ -0,0 +1,352 @@
+import asyncio
+
+import aiohttp
+
+import moltin_helpers
+from metrics_helpers import measure
+from moltin_helpers import (CART_ENDPOINT, CART_ITEM_ENDPOINT,
+                            CART_ITEMS_ENDPOINT, CATEGORIES_ENDPOINT,
+                            CATEGORY_ENDPOINT, CUSTOMERS_ENDPOINT,
+                            DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT,
+                            ENTRIES_ENDPOINT, ENTRY_ENDPOINT, FIELDS_ENDPOINT,
+                            FILE_ENDPOINT, FILES_ENDPOINT, FLOW_ENDPOINT,
+                            FLOW_FIELDS_ENDPOINT, FLOWS_ENDPOINT,
+                            MOLTIN_API_URL, PAGE_SIZE,
+                            PRODUCT_CATEGORIES_ENDPOINT, PRODUCT_ENDPOINT,
+                            PRODUCT_MAIN_IMAGE_ENDPOINT, PRODUCTS_ENDPOINT,
+                            RETRY_ATTEMPTS, RETRY_BACKOFF,
+                            get_cart_item_payload, get_category_payload,
+                            get_category_products_params,
+                            get_category_relationship_payload,
+                            get_customer_payload, get_entry_payload,
+                            get_flow_field_payload, get_flow_payload,
+                            get_image_files, get_main_image_payload,
+                            get_next_page_params, get_product_payload,
+                            get_slug_params, get_token_manager)
+
+DEFAULT_MAX_CONCURRENCY = 16
+
+_moltin_client = None
+
+
+class AsyncMoltinClient:
+    """
+    Асинхронный клиент Moltin. Сессия открывается и закрывается явно через `async with client:`
+    внутри цикла событий, в котором выполняются запросы.
+    """
+
+    def __init__(self, base_url=MOLTIN_API_URL, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        connect_timeout, read_timeout = timeout if isinstance(timeout, (tuple, list)) else (timeout, timeout)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_concurrency = max_concurrency
+        self.session = None
+        self._semaphore = None
+        self._auth_headers = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        if self.session is not None:
+            raise RuntimeError('Сессия клиента Moltin уже открыта')
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        session, self.session, self._semaphore = self.session, None, None
+        if session is not None:
+            await session.close()
+
+    def get_auth_headers(self, moltin_access_token):
+        headers = self._auth_headers.get(moltin_access_token)
+        if headers is None:
+            headers = {'Authorization': f'Bearer {moltin_access_token}'}
+            self._auth_headers = {moltin_access_token: headers}
+        return headers
+
+    async def request(self, method, endpoint, moltin_access_token, *path_args, **kwargs):
+        if self.session is None:
+            raise RuntimeError('Сессия клиента Moltin не открыта, используйте async with')
+        url = f'{self.base_url}{endpoint.format(*path_args)}'
+        if moltin_access_token:
+            kwargs['headers'] = self.get_auth_headers(moltin_access_token)
+        if 'files' in kwargs:
+            form = aiohttp.FormData()
+            for field_name, (_, field_value) in kwargs.pop('files').items():
+                form.add_field(field_name, field_value)
+            kwargs['data'] = form
+        async with self._semaphore:
+            with measure('upstream', service='moltin', call=f'{method} {endpoint}'):
+                async with self.session.request(method, url, **kwargs) as response:
+                    response.raise_for_status()
+                    if response.status == 204:
+                        return None
+                    return await response.json(content_type=None)
+
+    async def get(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return await self.request('GET', endpoint, moltin_access_token, *path_args, **kwargs)
+
+    async def post(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return await self.request('POST', endpoint, moltin_access_token, *path_args, **kwargs)
+
+    async def delete(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return await self.request('DELETE', endpoint, moltin_access_token, *path_args, **kwargs)
+
+
+def get_moltin_client(max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Клиент с адресом, пулом и таймаутами синхронного клиента из moltin_helpers."""
+    global _moltin_client
+    if _moltin_client is None:
+        sync_client = moltin_helpers.get_moltin_client()
+        _moltin_client = AsyncMoltinClient(sync_client.base_url, sync_client.pool_size, sync_client.timeout,
+                                           max_concurrency)
+    return _moltin_client
+
+
+def is_transient_error(error):
+    if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return False
+
+
+def get_retry_after(error):
+    if isinstance(error, aiohttp.ClientResponseError) and error.headers:
+        return error.headers.get('Retry-After')
+    return None
+
+
+async def call_with_retry(function, *args, attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, **kwargs):
+    for attempt in range(attempts):
+        try:
+            return await function(*args, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if attempt == attempts - 1 or not is_transient_error(error):
+                raise
+            retry_after = get_retry_after(error)
+            await asyncio.sleep(float(retry_after) if retry_after else backoff * 2 ** attempt)
+
+
+async def get_moltin_access_token(client_id, client_secret):
+    token_manager = get_token_manager(client_id, client_secret)
+    if token_manager.is_fresh(token_manager.refresh_margin):
+        return token_manager.access_token
+    return await asyncio.get_running_loop().run_in_executor(None, token_manager.get_token)
+
+
+async def get_page(endpoint, moltin_access_token, path_args, params):
+    return await get_moltin_client().get(endpoint, moltin_access_token, *path_args, params=params)
+
+
+async def iter_pages(endpoint, moltin_access_token, *path_args, params=None, page_size=PAGE_SIZE, prefetch=False):
+    page_params = {**(params or {}), 'page[limit]': page_size, 'page[offset]': 0}
+    page = await get_page(endpoint, moltin_access_token, path_args, page_params)
+    while page is not None:
+        next_page_params = get_next_page_params(page)
+        next_page = None
+        if next_page_params is not None:
+            next_page_params = {**(params or {}), **next_page_params}
+            if prefetch:
+                next_page = asyncio.ensure_future(get_page(endpoint, moltin_access_token, path_args, next_page_params))
+        yield page
+        if next_page_params is None:
+            return
+        if next_page is not None:
+            page = await next_page
+        else:
+            page = await get_page(endpoint, moltin_access_token, path_args, next_page_params)
+
+
+async def iter_items(endpoint, moltin_access_token, *path_args, **kwargs):
+    async for page in iter_pages(endpoint, moltin_access_token, *path_args, **kwargs):
+        for item in page['data']:
+            yield item
+
+
+async def download_product(moltin_access_token, name, description, price, slug):
+    payload = get_product_payload(name, description, price, slug)
+    response = await get_moltin_client().post(PRODUCTS_ENDPOINT, moltin_access_token, json=payload)
+    return response['data']
+
+
+async def download_image(moltin_access_token, image_url):
+    response = await get_moltin_client().post(FILES_ENDPOINT, moltin_access_token, files=get_image_files(image_url))
+    return response['data']
+
+
+async def get_image_by_id(moltin_access_token, image_id):
+    response = await get_moltin_client().get(FILE_ENDPOINT, moltin_access_token, image_id)
+    return response['data']
+
+
+def iter_images(moltin_access_token, **kwargs):
+    return iter_items(FILES_ENDPOINT, moltin_access_token, **kwargs)
+
+
+async def get_all_images(moltin_access_token, **kwargs):
+    return [image async for image in iter_images(moltin_access_token, **kwargs)]
+
+
+async def delete_image(moltin_access_token, image_id):
+    await get_moltin_client().delete(FILE_ENDPOINT, moltin_access_token, image_id)
+
+
+def iter_products(moltin_access_token, **kwargs):
+    return iter_items(PRODUCTS_ENDPOINT, moltin_access_token, **kwargs)
+
+
+async def get_all_products(moltin_access_token, **kwargs):
+    return [product async for product in iter_products(moltin_access_token, **kwargs)]
+
+
+async def delete_product(moltin_access_token, product_id):
+    await get_moltin_client().delete(PRODUCT_ENDPOINT, moltin_access_token, product_id)
+
+
+async def create_main_image_relationship(moltin_access_token, product_id, image_id):
+    await get_moltin_client().post(PRODUCT_MAIN_IMAGE_ENDPOINT, moltin_access_token, product_id,
+                                   json=get_main_image_payload(image_id))
+
+
+async def create_flow(moltin_access_token, flow_name, slug, description):
+    payload = get_flow_payload(flow_name, slug, description)
+    response = await get_moltin_client().post(FLOWS_ENDPOINT, moltin_access_token, json=payload)
+    return response['data']
+
+
+async def get_flow(moltin_access_token, flow_id):
+    response = await get_moltin_client().get(FLOW_ENDPOINT, moltin_access_token, flow_id)
+    return response['data']
+
+
+async def create_flow_field(moltin_access_token, flow_id, name, slug, field_type, description):
+    payload = get_flow_field_payload(flow_id, name, slug, field_type, description)
+    await get_moltin_client().post(FIELDS_ENDPOINT, moltin_access_token, json=payload)
+
+
+async def get_all_flow_fields(moltin_access_token, flow_slug):
+    response = await get_moltin_client().get(FLOW_FIELDS_ENDPOINT, moltin_access_token, flow_slug)
+    return response['data']
+
+
+async def create_pizzeria(moltin_access_token: str, flow_slug: str,
+                          alias_field_slug: str, alias: str,
+                          address_field_slug: str, address: str,
+                          longitude_field_slug: str, longitude: float,
+                          latitude_field_slug: str, latitude: float,
+                          courier_id_slug: str, courier_id: str):
+    payload = get_entry_payload({
+        alias_field_slug: alias,
+        address_field_slug: address,
+        longitude_field_slug: longitude,
+        latitude_field_slug: latitude,
+        courier_id_slug: courier_id,
+    })
+    return await get_moltin_client().post(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, json=payload)
+
+
+async def create_customer_address(moltin_access_token: str, flow_slug: str,
+                                  longitude_field_slug: str, longitude: float,
+                                  latitude_field_slug: str, latitude: float):
+    payload = get_entry_payload({
+        longitude_field_slug: longitude,
+        latitude_field_slug: latitude,
+    })
+    return await get_moltin_client().post(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, json=payload)
+
+
+async def delete_entry(moltin_access_token, flow_slug, entry_id):
+    await get_moltin_client().delete(ENTRY_ENDPOINT, moltin_access_token, flow_slug, entry_id)
+
+
+def iter_entries(moltin_access_token, flow_slug, **kwargs):
+    return iter_items(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, **kwargs)
+
+
+async def get_all_entries(moltin_access_token, flow_slug, **kwargs):
+    return [entry async for entry in iter_entries(moltin_access_token, flow_slug, **kwargs)]
+
+
+async def create_user_cart(moltin_access_token, cart_id):
+    return await get_moltin_client().get(CART_ENDPOINT, moltin_access_token, cart_id)
+
+
+async def add_product_to_cart(moltin_access_token, product_id, cart_id, quantity=1):
+    payload = get_cart_item_payload(product_id, quantity)
+    return await get_moltin_client().post(CART_ITEMS_ENDPOINT, moltin_access_token, cart_id, json=payload)
+
+
+async def get_cart_items(moltin_access_token, cart_id):
+    response = await get_moltin_client().get(CART_ITEMS_ENDPOINT, moltin_access_token, cart_id)
+    return response['data']
+
+
+async def get_product_by_id(moltin_access_token, product_id):
+    response = await get_moltin_client().get(PRODUCT_ENDPOINT, moltin_access_token, product_id)
+    return response['data']
+
+
+async def delete_product_from_cart(moltin_access_token, cart_id, product_id):
+    return await get_moltin_client().delete(CART_ITEM_ENDPOINT, moltin_access_token, cart_id, product_id)
+
+
+async def create_customer(moltin_access_token, name, email):
+    payload = get_customer_payload(name, email)
+    return await get_moltin_client().post(CUSTOMERS_ENDPOINT, moltin_access_token, json=payload)
+
+
+async def get_entry(moltin_access_token, flow_slug, entry_id):
+    response = await get_moltin_client().get(ENTRY_ENDPOINT, moltin_access_token, flow_slug, entry_id)
+    return response['data']
+
+
+async def create_category(moltin_access_token, name, slug, status='live'):
+    payload = get_category_payload(name, slug, status)
+    response = await get_moltin_client().post(CATEGORIES_ENDPOINT, moltin_access_token, json=payload)
+    return response['data']
+
+
+async def add_category_product(moltin_access_token, category_id, product_id):
+    await get_moltin_client().post(PRODUCT_CATEGORIES_ENDPOINT, moltin_access_token, product_id,
+                                   json=get_category_relationship_payload(category_id))
+
+
+async def get_category_by_id(moltin_access_token, category_id):
+    response = await get_moltin_client().get(CATEGORY_ENDPOINT, moltin_access_token, category_id)
+    return response['data']
+
+
+def iter_products_by_category_id(moltin_access_token, category_id, **kwargs):
+    params = get_category_products_params(category_id)
+    return iter_items(PRODUCTS_ENDPOINT, moltin_access_token, params=params, **kwargs)
+
+
+async def get_products_by_category_id(moltin_access_token, category_id, **kwargs):
+    return [product async for product in iter_products_by_category_id(moltin_access_token, category_id, **kwargs)]
+
+
+def iter_categories(moltin_access_token, **kwargs):
+    return iter_items(CATEGORIES_ENDPOINT, moltin_access_token, **kwargs)
+
+
+async def get_all_categories(moltin_access_token, **kwargs):
+    return [category async for category in iter_categories(moltin_access_token, **kwargs)]
+
+
+async def get_category_by_slug(moltin_access_token, category_slug):
+    params = get_slug_params(category_slug)
+    response = await get_moltin_client().get(CATEGORIES_ENDPOINT, moltin_access_token, params=params)
+    return response['data']
+
+
+async def delete_category(moltin_access_token, category_id):
+    await get_moltin_client().delete(CATEGORY_ENDPOINT, moltin_access_token, category_id)
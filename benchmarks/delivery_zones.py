@@ -0,0 +1,90 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.fake_moltin import CENTER_COORDINATES, FakeMoltinServer
+from benchmarks.stubs import MemoryRedis
+from delivery_zones import (CELL_SIZE_KM, REFINE_TIER, DeliveryZones,
+                            build_grid, dump_grid, get_places_fingerprint)
+from geo_helpers import NEAREST_CANDIDATES, get_delivery_tier
+from moltin_helpers import get_moltin_client
+from pizzeria_index import PlaceIndex
+
+TEST_CLIENT_ID = 'zones-benchmark-client'
+TEST_CLIENT_SECRET = 'zones-benchmark-secret'
+
+
+def get_random_coordinates(generator, count, radius_degrees):
+    latitude, longitude = CENTER_COORDINATES
+    return np.column_stack((
+        generator.uniform(latitude - radius_degrees, latitude + radius_degrees, count),
+        generator.uniform(longitude - radius_degrees * 1.6, longitude + radius_degrees * 1.6, count),
+    )).tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение сетки зон доставки с точным поиском ближайшей пиццерии')
+    parser.add_argument('--pizzerias', type=int, default=30)
+    parser.add_argument('--points', type=int, default=20000)
+    parser.add_argument('--radius', type=float, default=0.25, help='разброс точек вокруг центра, градусы широты')
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE_KM, help='размер ячейки, км')
+    args = parser.parse_args()
+
+    server = FakeMoltinServer(pizzerias_count=args.pizzerias).start()
+    get_moltin_client(base_url=server.url)
+    place_index = PlaceIndex(TEST_CLIENT_ID, TEST_CLIENT_SECRET, 'pizzeria')
+    place_index.load()
+    places = place_index.places
+
+    started_at = time.perf_counter()
+    grid = build_grid(places, args.cell_size)
+    build_seconds = time.perf_counter() - started_at
+    dumped_grid = dump_grid(grid, get_places_fingerprint(places))
+    refine_share = np.mean(grid['tiers'] == REFINE_TIER)
+    print(f'Сетка {grid["rows"]}x{grid["columns"]}: построение {build_seconds:.2f} с, '
+          f'{len(dumped_grid) / 1024:.0f} КБ в Redis, ячеек с точным уточнением {refine_share:.1%}')
+
+    db = MemoryRedis()
+    started_at = time.perf_counter()
+    DeliveryZones(place_index, db, cell_size_km=args.cell_size).update(places)
+    load_seconds = time.perf_counter() - started_at
+    delivery_zones = DeliveryZones(place_index, db, cell_size_km=args.cell_size)
+    started_at = time.perf_counter()
+    delivery_zones.update(places)
+    print(f'Построение и сохранение: {load_seconds:.2f} с, загрузка из Redis: {time.perf_counter() - started_at:.3f} с')
+
+    points = get_random_coordinates(np.random.default_rng(0), args.points, args.radius)
+    started_at = time.perf_counter()
+    zone_results = [delivery_zones.get_delivery(point) for point in points]
+    zone_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    exact_results = []
+    for point in points:
+        place, place_distance = place_index.get_nearest(point, k=NEAREST_CANDIDATES)[0]
+        exact_results.append((place, place_distance, get_delivery_tier(place_distance)))
+    exact_seconds = time.perf_counter() - started_at
+    server.shutdown()
+
+    place_mismatches = sum(
+        zone_place['id'] != exact_place['id']
+        for (zone_place, _, _), (exact_place, _, _) in zip(zone_results, exact_results)
+    )
+    tier_mismatches = sum(
+        zone_tier != exact_tier
+        for (_, _, zone_tier), (_, _, exact_tier) in zip(zone_results, exact_results)
+    )
+    stats = delivery_zones.get_stats()
+    print(f'{args.points} точек: сетка {zone_seconds / args.points * 1e6:.0f} мкс на точку, '
+          f'точный поиск {exact_seconds / args.points * 1e6:.0f} мкс на точку, '
+          f'ускорение x{exact_seconds / zone_seconds:.1f}')
+    print(f'Попаданий в сетку {stats["grid_hit_ratio"]:.1%}, уточнено {stats["refined"]}, '
+          f'вне сетки {stats["outside_grid"]}')
+    print(f'Расхождений: пиццерия {place_mismatches}, тариф {tier_mismatches}')
+    if place_mismatches or tier_mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0):
+        super().__init__(address, FakeGraphRequestHandler)
+        self.latency = latency
+        self.calls = Counter()
+        self.first_replies = {}
+        self.lock = threading.Lock()
+        self.replies_changed = threading.Condition(self.lock)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def record_messages(self, call_name, recipient_ids):
+        replied_at = time.time()
+        with self.replies_changed:
+            self.calls[call_name] += 1
+            self.calls['messages'] += len(recipient_ids)
+            for recipient_id in recipient_ids:
+                self.first_replies.setdefault(recipient_id, replied_at)
+            self.replies_changed.notify_all()
+
+    def wait_for_replies(self, recipient_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self.replies_changed:
+            while not all(recipient_id in self.first_replies for recipient_id in recipient_ids):
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    return False
+                self.replies_changed.wait(remaining_seconds)
+        return True
+
+    def get_first_replies(self):
+        with self.lock:
+            return dict(self.first_replies)
+
+    def get_calls(self):
+        with self.lock:
+            return Counter(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.first_replies.clear()
+
+
+class FakeGraphRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_length).decode('utf-8')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if urlsplit(self.path).path.endswith('/me/messages'):
+            recipient_id = json.loads(body)['recipient']['id']
+            self.server.record_messages('send', [recipient_id])
+            self.send_json({'recipient_id': recipient_id, 'message_id': uuid.uuid4().hex})
+            return
+        batch = json.loads(dict(parse_qsl(body))['batch'])
+        recipient_ids = [json.loads(dict(parse_qsl(request['body']))['recipient'])['id'] for request in batch]
+        self.server.record_messages('batch', recipient_ids)
+        self.send_json([
+            {
+                'code': 200,
+                'body': json.dumps({'recipient_id': recipient_id, 'message_id': uuid.uuid4().hex}),
+            }
+            for recipient_id in recipient_ids
+        ])
+
+    def send_json(self, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,261 @@
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+CENTER_COORDINATES = (55.751244, 37.618423)
+ROUTES = [
+    ('POST', re.compile(r'^/oauth/access_token$'), 'create_token'),
+    ('GET', re.compile(r'^/v2/products$'), 'get_products'),
+    ('GET', re.compile(r'^/v2/products/(?P<product_id>[^/]+)$'), 'get_product'),
+    ('GET', re.compile(r'^/v2/files$'), 'get_files'),
+    ('GET', re.compile(r'^/v2/files/(?P<file_id>[^/]+)$'), 'get_file'),
+    ('GET', re.compile(r'^/v2/categories$'), 'get_categories'),
+    ('GET', re.compile(r'^/v2/carts/(?P<cart_id>[^/]+)$'), 'get_cart'),
+    ('GET', re.compile(r'^/v2/carts/(?P<cart_id>[^/]+)/items$'), 'get_cart_items'),
+    ('POST', re.compile(r'^/v2/carts/(?P<cart_id>[^/]+)/items$'), 'add_cart_item'),
+    ('DELETE', re.compile(r'^/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)$'), 'delete_cart_item'),
+    ('GET', re.compile(r'^/v2/flows/(?P<flow_slug>[^/]+)/entries$'), 'get_entries'),
+    ('POST', re.compile(r'^/v2/flows/(?P<flow_slug>[^/]+)/entries$'), 'create_entry'),
+    ('GET', re.compile(r'^/v2/flows/(?P<flow_slug>[^/]+)/entries/(?P<entry_id>[^/]+)$'), 'get_entry'),
+    ('POST', re.compile(r'^/v2/customers$'), 'create_customer'),
+]
+
+
+def get_test_catalog(products_count=40, categories_count=5):
+    files = [
+        {'id': f'file-{product_number}', 'link': {'href': f'https://example.com/pizza-{product_number}.jpg'}}
+        for product_number in range(products_count)
+    ]
+    categories = [
+        {'id': f'category-{category_number}', 'name': f'Категория {category_number}',
+         'slug': 'main' if category_number == 0 else f'category-{category_number}'}
+        for category_number in range(categories_count)
+    ]
+    products = [
+        {
+            'id': f'product-{product_number}',
+            'type': 'product',
+            'name': f'Пицца {product_number}',
+            'description': 'Томатный соус, моцарелла, базилик',
+            'price': [{'amount': 400 + product_number * 10, 'currency': 'RUB', 'includes_tax': False}],
+            'relationships': {
+                'main_image': {'data': {'type': 'main_image', 'id': f'file-{product_number}'}},
+                'categories': {'data': [{'type': 'category', 'id': f'category-{product_number % categories_count}'}]},
+            },
+        }
+        for product_number in range(products_count)
+    ]
+    return products, files, categories
+
+
+def get_test_pizzerias(pizzerias_count=30, radius_degrees=0.1, seed=0):
+    randomizer = random.Random(seed)
+    return [
+        {
+            'id': f'pizzeria-{pizzeria_number}',
+            'type': 'entry',
+            'alias': f'Пиццерия {pizzeria_number}',
+            'address': f'Москва, улица {pizzeria_number}, дом 1',
+            'latitude': CENTER_COORDINATES[0] + randomizer.uniform(-radius_degrees, radius_degrees),
+            'longitude': CENTER_COORDINATES[1] + randomizer.uniform(-radius_degrees, radius_degrees),
+            'courier_id': str(900000 + pizzeria_number),
+        }
+        for pizzeria_number in range(pizzerias_count)
+    ]
+
+
+class FakeMoltinServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, products_count=40, pizzerias_count=30,
+                 categories_count=5):
+        super().__init__(address, FakeMoltinRequestHandler)
+        self.latency = latency
+        self.products, self.files, self.categories = get_test_catalog(products_count, categories_count)
+        self.entries = {'pizzeria': get_test_pizzerias(pizzerias_count), 'customer_address': []}
+        self.carts = {}
+        self.customers = []
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def get_calls(self):
+        with self.lock:
+            return Counter(self.calls)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+
+class FakeMoltinRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def route(self, method):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        content_length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_length) if content_length else b''
+        for route_method, pattern, handler_name in ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                with self.server.lock:
+                    self.server.calls[handler_name] += 1
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                status_code, content = getattr(self, handler_name)(query, body, **match.groupdict())
+                self.send_json(status_code, content, url.path, query)
+                return
+        self.send_json(404, {'errors': [{'title': 'Not Found'}]}, url.path, query)
+
+    def send_json(self, status_code, content, path, query):
+        if isinstance(content, list):
+            content = self.get_page(content, path, query)
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_page(self, items, path, query):
+        limit = int(query.get('page[limit]', 100))
+        offset = int(query.get('page[offset]', 0))
+        links = {'current': f'{self.server.url}{path}?{urlencode({**query, "page[offset]": offset})}'}
+        if offset + limit < len(items):
+            links['next'] = f'{self.server.url}{path}?{urlencode({**query, "page[offset]": offset + limit})}'
+        return {
+            'data': items[offset:offset + limit],
+            'links': links,
+            'meta': {'results': {'total': len(items)}},
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+    def create_token(self, query, body):
+        return 200, {'access_token': uuid.uuid4().hex, 'expires': int(time.time()) + 3600}
+
+    def get_products(self, query, body):
+        category_filter = re.match(r'eq\(category\.id,(.+)\)', query.get('filter', ''))
+        if not category_filter:
+            return 200, self.server.products
+        category_id = category_filter.group(1)
+        return 200, [
+            product for product in self.server.products
+            if product['relationships']['categories']['data'][0]['id'] == category_id
+        ]
+
+    def get_product(self, query, body, product_id):
+        for product in self.server.products:
+            if product['id'] == product_id:
+                return 200, {'data': product}
+        return 404, {'errors': [{'title': 'Product not found'}]}
+
+    def get_files(self, query, body):
+        return 200, self.server.files
+
+    def get_file(self, query, body, file_id):
+        for file in self.server.files:
+            if file['id'] == file_id:
+                return 200, {'data': file}
+        return 404, {'errors': [{'title': 'File not found'}]}
+
+    def get_categories(self, query, body):
+        slug_filter = re.match(r'eq\(slug,(.+)\)', query.get('filter', ''))
+        if not slug_filter:
+            return 200, self.server.categories
+        return 200, {'data': [category for category in self.server.categories
+                              if category['slug'] == slug_filter.group(1)]}
+
+    def get_cart(self, query, body, cart_id):
+        return 200, {'data': {'id': cart_id, 'type': 'cart'}}
+
+    def get_cart_items(self, query, body, cart_id):
+        with self.server.lock:
+            return 200, {'data': list(self.server.carts.get(cart_id, []))}
+
+    def add_cart_item(self, query, body, cart_id):
+        cart_item = json.loads(body)['data']
+        status_code, product = self.get_product(query, body, cart_item['id'])
+        if status_code != 200:
+            return status_code, product
+        product = product['data']
+        unit_price = product['price'][0]['amount']
+        with self.server.lock:
+            cart_items = self.server.carts.setdefault(cart_id, [])
+            for item in cart_items:
+                if item['product_id'] == product['id']:
+                    item['quantity'] += cart_item['quantity']
+                    item['value']['amount'] = unit_price * item['quantity']
+                    break
+            else:
+                cart_items.append({
+                    'id': uuid.uuid4().hex,
+                    'type': 'cart_item',
+                    'product_id': product['id'],
+                    'name': product['name'],
+                    'description': product['description'],
+                    'quantity': cart_item['quantity'],
+                    'unit_price': {'amount': unit_price, 'currency': 'RUB'},
+                    'value': {'amount': unit_price * cart_item['quantity'], 'currency': 'RUB'},
+                    'image': {'href': f'https://example.com/{product["id"]}.jpg'},
+                })
+            return 201, {'data': list(cart_items)}
+
+    def delete_cart_item(self, query, body, cart_id, item_id):
+        with self.server.lock:
+            cart_items = [item for item in self.server.carts.get(cart_id, []) if item['id'] != item_id]
+            self.server.carts[cart_id] = cart_items
+            return 200, {'data': list(cart_items)}
+
+    def get_entries(self, query, body, flow_slug):
+        return 200, self.server.entries.get(flow_slug, [])
+
+    def create_entry(self, query, body, flow_slug):
+        entry = dict(json.loads(body)['data'], id=uuid.uuid4().hex)
+        with self.server.lock:
+            self.server.entries.setdefault(flow_slug, []).append(entry)
+        return 201, {'data': entry}
+
+    def get_entry(self, query, body, flow_slug, entry_id):
+        for entry in self.server.entries.get(flow_slug, []):
+            if entry['id'] == entry_id:
+                return 200, {'data': entry}
+        return 404, {'errors': [{'title': 'Entry not found'}]}
+
+    def create_customer(self, query, body):
+        customer = dict(json.loads(body)['data'], id=uuid.uuid4().hex)
+        with self.server.lock:
+            self.server.customers.append(customer)
+        return 201, {'data': customer}
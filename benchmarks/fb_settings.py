@@ -0,0 +1,98 @@
+import argparse
+import importlib.util
+import os
+import statistics
+import time
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+import state_store
+from benchmarks.stubs import (MemoryRedis, get_json_response, get_percentile,
+                              get_test_categories)
+from catalog_helpers import save_categories
+from messenger_helpers import get_messenger_client
+from moltin_helpers import get_token_manager
+from rate_limit_helpers import TokenBucket
+
+FB_BOT_PATH = Path(__file__).resolve().parent.parent / 'fb-bot.py'
+TEST_ENV = {
+    'MOLTIN_CLIENT_ID': 'benchmark-client',
+    'MOLTIN_CLIENT_SECRET': 'benchmark-secret',
+    'PAGE_ACCESS_TOKEN': 'benchmark-page-token',
+    'VERIFY_TOKEN': 'benchmark-verify-token',
+    'DATABASE_HOST': 'localhost',
+    'DATABASE_PORT': '6379',
+}
+
+
+def load_fb_bot():
+    spec = importlib.util.spec_from_file_location('fb_bot', FB_BOT_PATH)
+    fb_bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fb_bot)
+    return fb_bot
+
+
+def stub_http_request(session, method, url, **kwargs):
+    if 'graph.facebook.com' in url:
+        return get_json_response({'recipient_id': '1', 'message_id': 'm'})
+    return get_json_response({'data': []})
+
+
+def measure_requests(client, fb_bot, requests_count, reload_settings):
+    webhook_payload = {
+        'object': 'page',
+        'entry': [{'messaging': [{'sender': {'id': '100'}, 'postback': {'payload': 'Категория;category-1'}}]}],
+    }
+    latencies = []
+    for _ in range(requests_count):
+        if reload_settings:
+            fb_bot._settings = None
+        started_at = time.perf_counter()
+        response = client.post('/', json=webhook_payload)
+        latencies.append(time.perf_counter() - started_at)
+        assert response.status_code == 200
+    return latencies
+
+
+def print_latencies(title, latencies):
+    latencies = sorted(latencies)
+    p95 = get_percentile(latencies, 0.95)
+    print(f'{title}: среднее {statistics.mean(latencies) * 1000:.3f} мс, '
+          f'медиана {statistics.median(latencies) * 1000:.3f} мс, p95 {p95 * 1000:.3f} мс')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Задержка вебхука fb-bot с чтением настроек на каждое сообщение и без')
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.update(TEST_ENV)
+    fb_bot = load_fb_bot()
+    db = MemoryRedis()
+    save_categories(db, get_test_categories(), 'category-0')
+    state_store._database = db
+    token_manager = get_token_manager(TEST_ENV['MOLTIN_CLIENT_ID'], TEST_ENV['MOLTIN_CLIENT_SECRET'])
+    token_manager.access_token, token_manager.expires = 'benchmark-token', time.time() + 3600
+    db.set('facebook_id_100', 'START')
+    messenger_client = get_messenger_client(TEST_ENV['PAGE_ACCESS_TOKEN'])
+    messenger_client.rate_limiter = TokenBucket(rate=10 ** 9, capacity=10 ** 9)
+
+    def handle_events_inline(db, queue_name, keyed_events):
+        for _, messaging_event in keyed_events:
+            fb_bot.handle_messaging_event(messaging_event)
+
+    client = fb_bot.app.test_client()
+    with mock.patch.object(requests.Session, 'request', stub_http_request), \
+            mock.patch.object(fb_bot, 'enqueue_events', handle_events_inline), \
+            mock.patch.object(fb_bot, 'get_event_workers'):
+        measure_requests(client, fb_bot, 100, reload_settings=False)
+        before = measure_requests(client, fb_bot, args.requests, reload_settings=True)
+        after = measure_requests(client, fb_bot, args.requests, reload_settings=False)
+    print_latencies('Настройки читаются на каждое сообщение', before)
+    print_latencies('Настройки загружены один раз', after)
+
+
+if __name__ == '__main__':
+    main()
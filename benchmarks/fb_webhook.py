@@ -0,0 +1,216 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import redis
+import requests
+
+from benchmarks.fake_graph import FakeGraphServer
+from benchmarks.fake_moltin import FakeMoltinServer
+from benchmarks.stubs import get_percentile
+from catalog_helpers import save_categories, save_products
+
+REPOSITORY_PATH = Path(__file__).resolve().parent.parent
+TEST_ENV = {
+    'MOLTIN_CLIENT_ID': 'webhook-benchmark-client',
+    'MOLTIN_CLIENT_SECRET': 'webhook-benchmark-secret',
+    'PAGE_ACCESS_TOKEN': 'webhook-benchmark-page-token',
+    'VERIFY_TOKEN': 'webhook-benchmark-verify-token',
+}
+STARTUP_TIMEOUT = 30
+
+
+def get_catalog_categories(moltin_server):
+    categories = []
+    for category in moltin_server.categories:
+        products = [
+            dict(product, image_link=f'https://example.com/{product["id"]}.jpg')
+            for product in moltin_server.products
+            if product['relationships']['categories']['data'][0]['id'] == category['id']
+        ]
+        categories.append(dict(category, products=products))
+    return categories
+
+
+def get_messaging_event(sender_id, event_number, products_count, categories_count):
+    event_kind = event_number % 4
+    if event_kind == 0:
+        event = {'message': {'mid': uuid.uuid4().hex, 'text': 'Привет'}}
+    elif event_kind == 1:
+        event = {'postback': {'payload': f'Категория;category-{event_number % categories_count}'}}
+    elif event_kind == 2:
+        event = {'postback': {'payload': f'Добавить в корзину;product-{event_number % products_count}'}}
+    else:
+        event = {'postback': {'payload': 'Корзина;'}}
+    return dict(event, sender={'id': sender_id}, recipient={'id': 'page'}, timestamp=int(time.time() * 1000))
+
+
+def get_webhook_payloads(run_id, batches, batch_size, products_count, categories_count):
+    payloads = []
+    for batch_number in range(batches):
+        entries = []
+        for event_number in range(batch_number * batch_size, (batch_number + 1) * batch_size):
+            sender_id = f'{run_id}-{event_number}'
+            entries.append({
+                'id': 'page',
+                'time': int(time.time() * 1000),
+                'messaging': [get_messaging_event(sender_id, event_number, products_count, categories_count)],
+            })
+        payloads.append({'object': 'page', 'entry': entries})
+    return payloads
+
+
+def start_fb_bot(args, moltin_server, graph_server):
+    env = dict(
+        os.environ,
+        **TEST_ENV,
+        DATABASE_HOST=args.redis_host,
+        DATABASE_PORT=str(args.redis_port),
+        MOLTIN_API_URL=moltin_server.url,
+        GRAPH_API_URL=graph_server.url,
+        FB_EVENT_WORKERS=str(args.event_workers),
+    )
+    if args.redis_password:
+        env['DATABASE_PASSWORD'] = args.redis_password
+    process = subprocess.Popen(
+        ['gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{args.port}', 'fb-bot:create_app()'],
+        cwd=REPOSITORY_PATH,
+        env=env,
+    )
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{args.port}/', timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('fb-bot не запустился')
+
+
+def post_payloads(url, payloads, clients):
+    posted_at = {}
+    webhook_latencies = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def post_payload(payload):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started_at = time.time()
+        response = local.session.post(url, json=payload, timeout=30)
+        elapsed_seconds = time.time() - started_at
+        response.raise_for_status()
+        with lock:
+            webhook_latencies.append(elapsed_seconds)
+            for entry in payload['entry']:
+                for messaging_event in entry['messaging']:
+                    posted_at[messaging_event['sender']['id']] = started_at
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(post_payload, payloads))
+    return posted_at, webhook_latencies
+
+
+def get_redis_commands(db):
+    return db.info('stats')['total_commands_processed']
+
+
+def run_catalog_size(args, db, products_count):
+    moltin_server = FakeMoltinServer(latency=args.moltin_latency / 1000, products_count=products_count).start()
+    graph_server = FakeGraphServer(latency=args.graph_latency / 1000).start()
+    categories = get_catalog_categories(moltin_server)
+    save_categories(db, categories, categories[0]['id'])
+    save_products(db, moltin_server.products)
+
+    process = start_fb_bot(args, moltin_server, graph_server)
+    url = f'http://127.0.0.1:{args.port}/'
+    try:
+        warm_up_payloads = get_webhook_payloads(uuid.uuid4().hex, args.workers * 2, args.batch_size,
+                                                products_count, len(categories))
+        warm_up_sender_ids, _ = post_payloads(url, warm_up_payloads, args.clients)
+        graph_server.wait_for_replies(warm_up_sender_ids, args.timeout)
+
+        moltin_server.reset_calls()
+        graph_server.reset()
+        redis_commands_before = get_redis_commands(db)
+        payloads = get_webhook_payloads(uuid.uuid4().hex, args.batches, args.batch_size,
+                                        products_count, len(categories))
+        posted_at, webhook_latencies = post_payloads(url, payloads, args.clients)
+        all_replied = graph_server.wait_for_replies(posted_at, args.timeout)
+        redis_commands = get_redis_commands(db) - redis_commands_before
+    finally:
+        process.terminate()
+        process.wait()
+        moltin_server.shutdown()
+        graph_server.shutdown()
+
+    first_replies = graph_server.get_first_replies()
+    event_latencies = sorted(
+        first_replies[sender_id] - event_posted_at
+        for sender_id, event_posted_at in posted_at.items()
+        if sender_id in first_replies
+    )
+    webhook_latencies.sort()
+    events_count = len(posted_at)
+    if not event_latencies:
+        print(f'Каталог: {products_count} пицц, ни одно из {events_count} событий не получило ответа')
+        return False
+    elapsed_seconds = max(first_replies.values()) - min(posted_at.values())
+    graph_calls = graph_server.get_calls()
+    moltin_calls = moltin_server.get_calls()
+
+    print(f'Каталог: {products_count} пицц, событий: {events_count}, '
+          f'без ответа: {events_count - len(event_latencies)}{"" if all_replied else " (таймаут)"}')
+    print(f'  Пропускная способность: {len(event_latencies) / elapsed_seconds:.1f} событий/с')
+    print(f'  Ответ вебхука: p50 {get_percentile(webhook_latencies, 0.5) * 1000:.1f} мс, '
+          f'p95 {get_percentile(webhook_latencies, 0.95) * 1000:.1f} мс, '
+          f'p99 {get_percentile(webhook_latencies, 0.99) * 1000:.1f} мс')
+    print(f'  От события до ответа пользователю: p50 {get_percentile(event_latencies, 0.5) * 1000:.1f} мс, '
+          f'p95 {get_percentile(event_latencies, 0.95) * 1000:.1f} мс, '
+          f'p99 {get_percentile(event_latencies, 0.99) * 1000:.1f} мс')
+    print(f'  На событие: запросов к Moltin {sum(moltin_calls.values()) / events_count:.2f}, '
+          f'запросов к Graph API {(graph_calls["send"] + graph_calls["batch"]) / events_count:.2f}, '
+          f'сообщений {graph_calls["messages"] / events_count:.2f}, '
+          f'команд Redis {redis_commands / events_count:.2f}')
+    for handler_name, calls in moltin_calls.most_common():
+        print(f'    {handler_name}: {calls / events_count:.2f}')
+    return all_replied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест вебхука фейсбук-бота под gunicorn с заглушками Graph API и Moltin',
+    )
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2, help='процессов gunicorn')
+    parser.add_argument('--event-workers', type=int, default=4, help='потоков обработки очереди в процессе')
+    parser.add_argument('--moltin-latency', type=float, default=30, help='задержка ответа Moltin, мс')
+    parser.add_argument('--graph-latency', type=float, default=30, help='задержка ответа Graph API, мс')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-password')
+    parser.add_argument('--timeout', type=float, default=120, help='ожидание ответов на все события, с')
+    args = parser.parse_args()
+
+    db = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_password,
+                     decode_responses=True)
+    all_replied = True
+    for products_count in args.catalog_sizes:
+        all_replied = run_catalog_size(args, db, products_count) and all_replied
+    if not all_replied:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
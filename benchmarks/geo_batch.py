@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import numpy as np
+from geopy import distance
+
+from geo_batch import get_nearest_places
+
+MOSCOW_BOUNDS = ((55.55, 55.95), (37.35, 37.85))
+
+
+def get_random_coordinates(generator, count):
+    (min_latitude, max_latitude), (min_longitude, max_longitude) = MOSCOW_BOUNDS
+    return np.column_stack((
+        generator.uniform(min_latitude, max_latitude, count),
+        generator.uniform(min_longitude, max_longitude, count),
+    ))
+
+
+def get_nearest_place_by_geopy(customer_coordinates, place_coordinates):
+    return min(
+        range(len(place_coordinates)),
+        key=lambda place_number: distance.distance(place_coordinates[place_number], customer_coordinates).km,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение пакетного поиска ближайших пиццерий с geopy')
+    parser.add_argument('--pizzerias', type=int, default=100)
+    parser.add_argument('--customers', type=int, nargs='+', default=[10 ** 3, 10 ** 5, 10 ** 6])
+    parser.add_argument('--geopy-sample', type=int, default=200)
+    args = parser.parse_args()
+
+    generator = np.random.default_rng(0)
+    place_coordinates = get_random_coordinates(generator, args.pizzerias)
+
+    sample = get_random_coordinates(generator, args.geopy_sample)
+    started_at = time.perf_counter()
+    geopy_place_numbers = [get_nearest_place_by_geopy(point, place_coordinates) for point in sample]
+    geopy_seconds_per_point = (time.perf_counter() - started_at) / args.geopy_sample
+    vectorized_place_numbers, _, _ = get_nearest_places(sample, place_coordinates, refine=True)
+    matches = np.mean(np.array(geopy_place_numbers) == vectorized_place_numbers)
+    print(f'geopy: {geopy_seconds_per_point * 1000:.2f} мс на точку, '
+          f'совпадение с векторным поиском {matches:.1%}')
+
+    for customers_count in args.customers:
+        customer_coordinates = get_random_coordinates(generator, customers_count)
+        started_at = time.perf_counter()
+        get_nearest_places(customer_coordinates, place_coordinates)
+        vectorized_seconds = time.perf_counter() - started_at
+        print(f'{customers_count} точек: векторно {vectorized_seconds:.2f} с, '
+              f'geopy ~{geopy_seconds_per_point * customers_count:.0f} с, '
+              f'ускорение x{geopy_seconds_per_point * customers_count / vectorized_seconds:.0f}')
+
+
+if __name__ == '__main__':
+    main()
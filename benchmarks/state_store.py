@@ -0,0 +1,46 @@
+import argparse
+import random
+import time
+
+from benchmarks.stubs import MemoryRedis
+from state_store import StateStore
+
+STATES = ['START', 'HANDLE_MENU', 'HANDLE_DESCRIPTION', 'HANDLE_CART', 'WAITING_ADDRESS']
+
+
+def run_legacy(db, updates):
+    for chat_id in updates:
+        db.get(f'telegram_id_{chat_id}')
+        db.set(f'telegram_id_{chat_id}', random.choice(STATES))
+
+
+def run_state_store(db, updates, cache_size):
+    state_store = StateStore(db, 'telegram_id_{}', default_state='START', cache_size=cache_size)
+    for chat_id in updates:
+        state_store.get_state(chat_id)
+        state_store.set_state(chat_id, random.choice(STATES))
+
+
+def measure(title, run, updates, *args):
+    db = MemoryRedis()
+    started_at = time.perf_counter()
+    run(db, updates, *args)
+    elapsed_seconds = time.perf_counter() - started_at
+    print(f'{title}: {db.commands / len(updates):.2f} команд Redis на апдейт, '
+          f'{elapsed_seconds / len(updates) * 10 ** 6:.1f} мкс на апдейт')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Количество обращений к Redis за состоянием диалога')
+    parser.add_argument('--updates', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=1000)
+    args = parser.parse_args()
+
+    updates = [random.randrange(args.chats) for _ in range(args.updates)]
+    measure('GET + SET на каждый апдейт', run_legacy, updates)
+    measure('StateStore без локального кэша', run_state_store, updates, 0)
+    measure('StateStore с локальным кэшем', run_state_store, updates, args.chats)
+
+
+if __name__ == '__main__':
+    main()
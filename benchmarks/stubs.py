@@ -0,0 +1,180 @@
+import fnmatch
+import json
+import threading
+import time
+
+import requests
+from redis.exceptions import WatchError
+
+
+class MemoryRedis:
+
+    def __init__(self):
+        self.values = {}
+        self.expires_at = {}
+        self.versions = {}
+        self.commands = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            self.commands += 1
+            self._expire(key)
+            return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            self.commands += 1
+            self._expire(key)
+            if nx and key in self.values:
+                return None
+            self.values[key] = value if isinstance(value, str) else str(value)
+            self._touch(key)
+            if ex:
+                self.expires_at[key] = time.monotonic() + ex
+            return True
+
+    def ttl(self, key):
+        with self._lock:
+            self.commands += 1
+            self._expire(key)
+            if key not in self.values:
+                return -2
+            if key not in self.expires_at:
+                return -1
+            return max(int(self.expires_at[key] - time.monotonic()), 0)
+
+    def mget(self, keys):
+        with self._lock:
+            self.commands += 1
+            for key in keys:
+                self._expire(key)
+            return [self.values.get(key) for key in keys]
+
+    def delete(self, *keys):
+        with self._lock:
+            self.commands += 1
+            for key in keys:
+                self._touch(key)
+            return sum(self.values.pop(key, None) is not None for key in keys)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            self.commands += 1
+            self.expires_at[key] = time.monotonic() + seconds
+
+    def rpush(self, key, *values):
+        with self._lock:
+            self.commands += 1
+            self.values.setdefault(key, []).extend(values)
+
+    def lpop(self, key):
+        with self._lock:
+            self.commands += 1
+            values = self.values.get(key)
+            return values.pop(0) if values else None
+
+    def llen(self, key):
+        with self._lock:
+            self.commands += 1
+            return len(self.values.get(key) or [])
+
+    def keys(self, pattern='*'):
+        with self._lock:
+            return [key for key in self.values if fnmatch.fnmatch(key, pattern)]
+
+    def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _expire(self, key):
+        if key in self.expires_at and self.expires_at[key] <= time.monotonic():
+            self.values.pop(key, None)
+            self.expires_at.pop(key, None)
+
+
+class MemoryPipeline:
+
+    def __init__(self, db):
+        self.db = db
+        self.calls = []
+        self.watched_versions = None
+        self.queueing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __getattr__(self, name):
+        if self.watched_versions is not None and not self.queueing:
+            return getattr(self.db, name)
+
+        def queue_call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue_call
+
+    def watch(self, *keys):
+        with self.db._lock:
+            self.db.commands += 1
+            self.watched_versions = {key: self.db.versions.get(key, 0) for key in keys}
+        self.queueing = False
+
+    def multi(self):
+        self.queueing = True
+
+    def reset(self):
+        self.calls = []
+        self.watched_versions = None
+        self.queueing = False
+
+    def execute(self):
+        with self.db._lock:
+            watched_versions = self.watched_versions or {}
+            if any(self.db.versions.get(key, 0) != version for key, version in watched_versions.items()):
+                self.reset()
+                raise WatchError('Watched variable changed.')
+            results = [getattr(self.db, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+            self.db.commands -= max(len(self.calls) - 1, 0)
+        self.reset()
+        return results
+
+
+def get_json_response(content, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(content).encode('utf-8')
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def get_test_categories(categories_count=5, products_per_category=8):
+    return [
+        {
+            'id': f'category-{category_number}',
+            'name': f'Категория {category_number}',
+            'slug': 'main' if category_number == 0 else f'category-{category_number}',
+            'products': [
+                {
+                    'id': f'product-{category_number}-{product_number}',
+                    'name': f'Пицца {category_number}-{product_number}',
+                    'description': 'Томатный соус, моцарелла',
+                    'price': [{'amount': 400, 'currency': 'RUB'}],
+                    'image_link': 'https://example.com/pizza.jpg',
+                }
+                for product_number in range(products_per_category)
+            ],
+        }
+        for category_number in range(categories_count)
+    ]
+
+
+def get_percentile(sorted_values, percentile):
+    return sorted_values[min(int(len(sorted_values) * percentile), len(sorted_values) - 1)]
@@ -0,0 +1,202 @@
+import argparse
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import state_store
+import tg_bot
+from benchmarks.fake_moltin import CENTER_COORDINATES, FakeMoltinServer
+from benchmarks.stubs import MemoryRedis, get_percentile
+from cart_helpers import flush_cart_reconciles, get_cart_stats
+from catalog_helpers import save_products
+from moltin_helpers import get_all_products, get_moltin_client
+
+TEST_CLIENT_ID = 'load-test-client'
+TEST_CLIENT_SECRET = 'load-test-secret'
+
+
+class FakeBot:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(message_id=1, photo=[SimpleNamespace(file_id=f'file-id-{method}')])
+
+    def send_message(self, **kwargs):
+        return self.call('sendMessage')
+
+    def send_photo(self, **kwargs):
+        return self.call('sendPhoto')
+
+    def delete_message(self, **kwargs):
+        return self.call('deleteMessage')
+
+    def send_location(self, *args, **kwargs):
+        return self.call('sendLocation')
+
+    def send_invoice(self, *args, **kwargs):
+        return self.call('sendInvoice')
+
+    def get_calls(self):
+        with self._lock:
+            return Counter(self.calls)
+
+
+def get_message_update(bot, chat_id, text=None, location=None):
+    message = SimpleNamespace(
+        text=text,
+        chat_id=chat_id,
+        location=location,
+        reply_text=lambda *args, **kwargs: bot.call('sendMessage'),
+    )
+    return SimpleNamespace(
+        message=message,
+        callback_query=None,
+        edited_message=None,
+        effective_user=SimpleNamespace(id=chat_id, first_name='Тест'),
+    )
+
+
+def get_callback_update(bot, chat_id, data):
+    callback_query = SimpleNamespace(
+        data=data,
+        message=SimpleNamespace(chat_id=chat_id, message_id=1),
+        answer=lambda *args, **kwargs: bot.call('answerCallbackQuery'),
+    )
+    return SimpleNamespace(
+        message=None,
+        callback_query=callback_query,
+        edited_message=None,
+        effective_user=SimpleNamespace(id=chat_id, first_name='Тест'),
+    )
+
+
+def get_journey(bot, chat_id, product_id):
+    latitude, longitude = CENTER_COORDINATES
+    location = SimpleNamespace(latitude=latitude, longitude=longitude)
+    return [
+        ('START', get_message_update(bot, chat_id, text='/start'), 'HANDLE_MENU'),
+        ('HANDLE_MENU', get_callback_update(bot, chat_id, 'page-1'), 'HANDLE_MENU'),
+        ('HANDLE_MENU', get_callback_update(bot, chat_id, product_id), 'HANDLE_DESCRIPTION'),
+        ('HANDLE_DESCRIPTION', get_callback_update(bot, chat_id, product_id), 'HANDLE_DESCRIPTION'),
+        ('HANDLE_DESCRIPTION', get_callback_update(bot, chat_id, 'Корзина'), 'HANDLE_CART'),
+        ('HANDLE_CART', get_callback_update(bot, chat_id, 'Оформить заказ'), 'HANDLE_WAITING_EMAIL'),
+        ('HANDLE_WAITING_EMAIL', get_message_update(bot, chat_id, text=f'user{chat_id}@example.com'),
+         'HANDLE_WAITING_ADDRESS'),
+        ('HANDLE_WAITING_ADDRESS', get_message_update(bot, chat_id, location=location), 'HANDLE_WAITING_DELIVERY'),
+        ('HANDLE_WAITING_DELIVERY',
+         get_callback_update(bot, chat_id, f'Доставка;900000,{chat_id},{latitude},{longitude}'),
+         'HANDLE_USERS_REPLY'),
+    ]
+
+
+class LoadTest:
+
+    def __init__(self, bot, db, products_count):
+        self.bot = bot
+        self.db = db
+        self.products_count = products_count
+        self.latencies = defaultdict(list)
+        self.failed_journeys = 0
+        self._lock = threading.Lock()
+
+    def run_journey(self, chat_id):
+        product_id = f'product-{chat_id % self.products_count}'
+        for state, update, expected_state in get_journey(self.bot, chat_id, product_id):
+            started_at = time.perf_counter()
+            tg_bot.handle_users_reply(self.bot, update)
+            elapsed_seconds = time.perf_counter() - started_at
+            with self._lock:
+                self.latencies[state].append(elapsed_seconds)
+            if tg_bot.get_state_store().get_state(chat_id) != expected_state:
+                with self._lock:
+                    self.failed_journeys += 1
+                return
+
+    def run(self, journeys, concurrency, first_chat_id):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.run_journey, range(first_chat_id, first_chat_id + journeys)))
+
+
+def wait_for_reconciles(timeout=30):
+    deadline = time.monotonic() + timeout
+    while get_cart_stats()['pending_reconciles'] and time.monotonic() < deadline:
+        flush_cart_reconciles()
+        time.sleep(0.05)
+
+
+def print_report(load_test, journeys, elapsed_seconds, moltin_calls, telegram_calls, redis_commands):
+    updates = sum(len(latencies) for latencies in load_test.latencies.values())
+    print(f'Путей пользователя: {journeys}, неудачных: {load_test.failed_journeys}')
+    print(f'Пропускная способность: {updates / elapsed_seconds:.1f} апдейтов/с, '
+          f'{journeys / elapsed_seconds:.1f} путей/с')
+    print(f'{"Состояние":<25}{"N":>7}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+    for state, latencies in load_test.latencies.items():
+        latencies = sorted(latencies)
+        print(f'{state:<25}{len(latencies):>7}'
+              f'{get_percentile(latencies, 0.5) * 1000:>10.1f}'
+              f'{get_percentile(latencies, 0.95) * 1000:>10.1f}'
+              f'{get_percentile(latencies, 0.99) * 1000:>10.1f}')
+    print(f'Запросов к Moltin на путь: {sum(moltin_calls.values()) / journeys:.2f}')
+    for handler_name, calls in moltin_calls.most_common():
+        print(f'  {handler_name}: {calls / journeys:.2f}')
+    print(f'Запросов к Telegram на путь: {sum(telegram_calls.values()) / journeys:.2f}')
+    print(f'Команд Redis на путь: {redis_commands / journeys:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест диалога телеграм-бота с локальной заглушкой Moltin')
+    parser.add_argument('--journeys', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warm-up', type=int, default=8)
+    parser.add_argument('--moltin-latency', type=float, default=30, help='задержка ответа Moltin, мс')
+    parser.add_argument('--telegram-latency', type=float, default=30, help='задержка ответа Telegram, мс')
+    parser.add_argument('--products', type=int, default=40)
+    parser.add_argument('--pizzerias', type=int, default=30)
+    parser.add_argument('--max-p95', type=float, help='максимально допустимый p95 любого состояния, мс')
+    args = parser.parse_args()
+
+    server = FakeMoltinServer(latency=args.moltin_latency / 1000, products_count=args.products,
+                              pizzerias_count=args.pizzerias).start()
+    get_moltin_client(base_url=server.url, pool_size=args.concurrency)
+    db = MemoryRedis()
+    state_store._database = db
+    tg_bot.moltin_client_id, tg_bot.moltin_client_secret = TEST_CLIENT_ID, TEST_CLIENT_SECRET
+    tg_bot.yandex_api_key, tg_bot.provider_token = 'load-test-key', 'load-test-provider'
+    token = tg_bot.get_moltin_access_token(TEST_CLIENT_ID, TEST_CLIENT_SECRET)
+    save_products(db, get_all_products(token))
+
+    bot = FakeBot(latency=args.telegram_latency / 1000)
+    LoadTest(bot, db, args.products).run(args.warm_up, args.concurrency, first_chat_id=1)
+    wait_for_reconciles()
+    server.reset_calls()
+    telegram_calls_before, redis_commands_before = bot.get_calls(), db.commands
+
+    load_test = LoadTest(bot, db, args.products)
+    started_at = time.perf_counter()
+    load_test.run(args.journeys, args.concurrency, first_chat_id=100000)
+    elapsed_seconds = time.perf_counter() - started_at
+    wait_for_reconciles()
+
+    print_report(load_test, args.journeys, elapsed_seconds, server.get_calls(),
+                 bot.get_calls() - telegram_calls_before, db.commands - redis_commands_before)
+    server.shutdown()
+    if args.max_p95:
+        worst_p95 = max(get_percentile(sorted(latencies), 0.95) for latencies in load_test.latencies.values())
+        if load_test.failed_journeys or worst_p95 * 1000 > args.max_p95:
+            print(f'Порог не пройден: худший p95 {worst_p95 * 1000:.1f} мс')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_moltin import FakeMoltinServer
+from moltin_helpers import (call_with_retry, get_all_categories,
+                            get_moltin_client, get_products_by_category_id)
+from update_db import MAX_WORKERS, fetch_categories_products
+
+TEST_ACCESS_TOKEN = 'benchmark-token'
+
+
+def fetch_sequentially(categories):
+    return [
+        call_with_retry(get_products_by_category_id, TEST_ACCESS_TOKEN, category.get('id'))
+        for category in categories
+    ]
+
+
+def fetch_in_threads(categories):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(
+            lambda category: call_with_retry(get_products_by_category_id, TEST_ACCESS_TOKEN, category.get('id')),
+            categories,
+        ))
+
+
+def fetch_with_gather(categories):
+    return asyncio.run(fetch_categories_products(TEST_ACCESS_TOKEN, categories))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Загрузка товаров по категориям в update_db: '
+                                                 'последовательно, в пуле потоков и через asyncio.gather')
+    parser.add_argument('--categories', type=int, nargs='+', default=[5, 20, 100])
+    parser.add_argument('--products-per-category', type=int, default=8)
+    parser.add_argument('--moltin-latency', type=float, default=30, help='задержка заглушки Moltin, мс')
+    args = parser.parse_args()
+
+    fetchers = {
+        'последовательно': fetch_sequentially,
+        f'пул из {MAX_WORKERS} потоков': fetch_in_threads,
+        'asyncio.gather': fetch_with_gather,
+    }
+    max_categories = max(args.categories)
+    server = FakeMoltinServer(latency=args.moltin_latency / 1000,
+                              products_count=max_categories * args.products_per_category,
+                              categories_count=max_categories).start()
+    get_moltin_client(base_url=server.url)
+    all_categories = get_all_categories(TEST_ACCESS_TOKEN)
+    for categories_count in args.categories:
+        categories = all_categories[:categories_count]
+        print(f'Категорий: {categories_count}')
+        expected_products = None
+        for title, fetch in fetchers.items():
+            started_at = time.perf_counter()
+            categories_products = fetch(categories)
+            elapsed = time.perf_counter() - started_at
+            if expected_products is None:
+                expected_products = categories_products
+            mismatches = sum(
+                products != expected
+                for products, expected in zip(categories_products, expected_products)
+            )
+            print(f'  {title}: {elapsed:.3f} с, расхождений {mismatches}')
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from redis.exceptions import WatchError
+
+from catalog_helpers import get_products
+from moltin_helpers import (add_product_to_cart, delete_product_from_cart,
+                            get_cart_items, get_product_by_id)
+
+CART_KEY = 'cart_{}'
+CART_TTL = 24 * 60 * 60
+RECONCILE_WORKERS = 2
+RECONCILE_DELAY = 30
+RECONCILE_CHECK_INTERVAL = 1
+UNKNOWN_PRODUCT_NAME = 'пицца'
+
+logger = logging.getLogger('cart_helpers')
+
+_reconcile_executor = ThreadPoolExecutor(max_workers=RECONCILE_WORKERS)
+_reconcile_scheduler = None
+_pending_reconciles = {}
+_running_reconciles = set()
+_cart_stats = {
+    'hits': 0,
+    'misses': 0,
+    'local_updates': 0,
+    'reconciled': 0,
+    'reconcile_conflicts': 0,
+    'diverged': 0,
+    'reconcile_errors': 0,
+}
+_cart_stats_lock = threading.Lock()
+
+
+def count_cart_event(name):
+    with _cart_stats_lock:
+        _cart_stats[name] += 1
+
+
+def get_cart_stats():
+    with _cart_stats_lock:
+        stats = dict(_cart_stats)
+        stats['pending_reconciles'] = len(_pending_reconciles) + len(_running_reconciles)
+    stats['divergence_rate'] = stats['diverged'] / stats['reconciled'] if stats['reconciled'] else 0
+    return stats
+
+
+def get_cart_signature(cart_items):
+    return sorted((item.get('id'), item.get('product_id'), item.get('quantity')) for item in cart_items)
+
+
+def save_cart_items(db, cart_id, cart_items):
+    db.set(CART_KEY.format(cart_id), json.dumps(cart_items), ex=CART_TTL)
+
+
+def get_cached_cart_items(db, moltin_access_token, cart_id):
+    raw_cart_items = db.get(CART_KEY.format(cart_id))
+    if raw_cart_items is not None:
+        count_cart_event('hits')
+        return json.loads(raw_cart_items)
+    count_cart_event('misses')
+    cart_items = get_cart_items(moltin_access_token, cart_id)
+    save_cart_items(db, cart_id, cart_items)
+    return cart_items
+
+
+def add_to_cart(db, moltin_access_token, product_id, cart_id, quantity=1):
+    response = add_product_to_cart(moltin_access_token, product_id, cart_id, quantity)
+    return update_cart_mirror(db, moltin_access_token, cart_id, response)
+
+
+def remove_from_cart(db, moltin_access_token, cart_id, item_id):
+    response = delete_product_from_cart(moltin_access_token, cart_id, item_id)
+    if response and isinstance(response.get('data'), list):
+        return update_cart_mirror(db, moltin_access_token, cart_id, response)
+    raw_cart_items = db.get(CART_KEY.format(cart_id))
+    if raw_cart_items is None:
+        return get_cached_cart_items(db, moltin_access_token, cart_id)
+    cart_items = [item for item in json.loads(raw_cart_items) if item.get('id') != item_id]
+    save_cart_items(db, cart_id, cart_items)
+    count_cart_event('local_updates')
+    schedule_cart_reconcile(db, moltin_access_token, cart_id)
+    return cart_items
+
+
+def update_cart_mirror(db, moltin_access_token, cart_id, response):
+    cart_items = response.get('data') if response else None
+    if not isinstance(cart_items, list):
+        db.delete(CART_KEY.format(cart_id))
+        return get_cached_cart_items(db, moltin_access_token, cart_id)
+    save_cart_items(db, cart_id, cart_items)
+    count_cart_event('local_updates')
+    schedule_cart_reconcile(db, moltin_access_token, cart_id)
+    return cart_items
+
+
+def get_product_name(db, moltin_access_token, cart_items, product_id):
+    for item in cart_items:
+        if item.get('product_id') == product_id:
+            return item.get('name')
+    for product in get_products(db, moltin_access_token):
+        if product.get('id') == product_id:
+            return product.get('name')
+    try:
+        return get_product_by_id(moltin_access_token, product_id).get('name') or UNKNOWN_PRODUCT_NAME
+    except requests.RequestException:
+        logger.exception(f'Не удалось получить название товара {product_id}')
+        return UNKNOWN_PRODUCT_NAME
+
+
+def reconcile_cart(db, moltin_access_token, cart_id):
+    with _cart_stats_lock:
+        _pending_reconciles.pop(str(cart_id), None)
+    cart_key = CART_KEY.format(cart_id)
+    with db.pipeline() as pipe:
+        pipe.watch(cart_key)
+        raw_cart_items = pipe.get(cart_key)
+        cart_items = get_cart_items(moltin_access_token, cart_id)
+        pipe.multi()
+        pipe.set(cart_key, json.dumps(cart_items), ex=CART_TTL)
+        try:
+            pipe.execute()
+        except WatchError:
+            count_cart_event('reconcile_conflicts')
+            return cart_items
+    count_cart_event('reconciled')
+    if raw_cart_items is not None and get_cart_signature(json.loads(raw_cart_items)) != get_cart_signature(cart_items):
+        count_cart_event('diverged')
+        logger.warning(f'Корзина {cart_id} расходится с Moltin')
+    return cart_items
+
+
+def schedule_cart_reconcile(db, moltin_access_token, cart_id):
+    """Сверяет копию корзины с Moltin через RECONCILE_DELAY секунд после последнего изменения."""
+    global _reconcile_scheduler
+    with _cart_stats_lock:
+        _pending_reconciles[str(cart_id)] = (time.monotonic() + RECONCILE_DELAY, db, moltin_access_token)
+        if _reconcile_scheduler is None:
+            _reconcile_scheduler = threading.Thread(target=_run_reconcile_scheduler, daemon=True)
+            _reconcile_scheduler.start()
+
+
+def flush_cart_reconciles():
+    with _cart_stats_lock:
+        cart_ids = list(_pending_reconciles)
+    for cart_id in cart_ids:
+        _start_cart_reconcile(cart_id, due_at=None)
+
+
+def _run_reconcile_scheduler():
+    while True:
+        time.sleep(RECONCILE_CHECK_INTERVAL)
+        with _cart_stats_lock:
+            cart_ids = list(_pending_reconciles)
+        for cart_id in cart_ids:
+            _start_cart_reconcile(cart_id, due_at=time.monotonic())
+
+
+def _start_cart_reconcile(cart_id, due_at):
+    with _cart_stats_lock:
+        pending_reconcile = _pending_reconciles.get(cart_id)
+        if pending_reconcile is None or cart_id in _running_reconciles:
+            return None
+        if due_at is not None and pending_reconcile[0] > due_at:
+            return None
+        del _pending_reconciles[cart_id]
+        _running_reconciles.add(cart_id)
+    _, db, moltin_access_token = pending_reconcile
+    return _reconcile_executor.submit(_run_cart_reconcile, db, moltin_access_token, cart_id)
+
+
+def _run_cart_reconcile(db, moltin_access_token, cart_id):
+    try:
+        reconcile_cart(db, moltin_access_token, cart_id)
+    except Exception:
+        count_cart_event('reconcile_errors')
+        logger.exception(f'Не удалось сверить корзину {cart_id}')
+    finally:
+        with _cart_stats_lock:
+            _running_reconciles.discard(cart_id)
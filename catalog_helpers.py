@@ -0,0 +1,158 @@
+import hashlib
+import json
+import threading
+import time
+
+from moltin_helpers import get_all_products
+
+PRODUCTS_KEY = 'products'
+CATALOG_VERSION_KEY = 'catalog_version'
+CATEGORY_KEY = 'category_{}'
+CATEGORIES_INDEX_KEY = 'categories_index'
+CATEGORIES_VERSION_KEY = 'categories_version'
+CATALOG_UPDATES_CHANNEL = 'catalog_updates'
+VERSION_CHECK_INTERVAL = 5
+CATEGORIES_CHECK_INTERVAL = 60
+
+_products_snapshot = {'version': None, 'products': None, 'checked_at': 0}
+_products_snapshot_lock = threading.Lock()
+_categories_snapshot = {'version': None, 'index': None, 'categories': {}, 'checked_at': 0}
+_categories_snapshot_lock = threading.Lock()
+_catalog_listener = None
+
+
+def get_content_hash(content):
+    serialized_content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(serialized_content.encode('utf-8')).hexdigest()
+
+
+def save_products(db, products):
+    version = get_content_hash(products)
+    if db.get(CATALOG_VERSION_KEY) == version:
+        return False
+    pipe = db.pipeline()
+    pipe.set(PRODUCTS_KEY, json.dumps(products))
+    pipe.set(CATALOG_VERSION_KEY, version)
+    pipe.execute()
+    return True
+
+
+def get_products(db, moltin_access_token):
+    with _products_snapshot_lock:
+        snapshot = dict(_products_snapshot)
+    now = time.monotonic()
+    if snapshot['products'] is not None and now - snapshot['checked_at'] < VERSION_CHECK_INTERVAL:
+        return snapshot['products']
+    version = db.get(CATALOG_VERSION_KEY)
+    if version and version == snapshot['version']:
+        products = snapshot['products']
+    else:
+        raw_products = db.get(PRODUCTS_KEY) if version else None
+        if raw_products:
+            products = json.loads(raw_products)
+        else:
+            version = None
+            products = get_all_products(moltin_access_token)
+    with _products_snapshot_lock:
+        _products_snapshot.update(version=version, products=products, checked_at=now)
+    return products
+
+
+def get_categories_index(db):
+    raw_index = db.get(CATEGORIES_INDEX_KEY)
+    if not raw_index:
+        return {'version': None, 'front_page_category_id': None, 'categories': []}
+    return json.loads(raw_index)
+
+
+def get_category(db, category_id):
+    raw_category = db.get(CATEGORY_KEY.format(category_id))
+    return json.loads(raw_category) if raw_category else None
+
+
+def get_front_page_category(db):
+    return get_category(db, get_categories_index(db)['front_page_category_id'])
+
+
+def save_categories(db, categories, front_page_category_id):
+    cached_index = get_categories_index(db)
+    cached_hashes = {category['id']: category['hash'] for category in cached_index['categories']}
+    index_categories = []
+    changed_categories = []
+    for category in categories:
+        category_hash = get_content_hash(category)
+        index_categories.append({
+            'id': category.get('id'),
+            'name': category.get('name'),
+            'slug': category.get('slug'),
+            'hash': category_hash,
+        })
+        if cached_hashes.get(category.get('id')) != category_hash:
+            changed_categories.append(category)
+    removed_category_ids = set(cached_hashes) - {category.get('id') for category in categories}
+    index = {
+        'front_page_category_id': front_page_category_id,
+        'categories': index_categories,
+    }
+    version = get_content_hash(index)
+    index['version'] = version
+    if not changed_categories and not removed_category_ids and cached_index['version'] == version:
+        return []
+
+    pipe = db.pipeline()
+    for category in changed_categories:
+        pipe.set(CATEGORY_KEY.format(category.get('id')), json.dumps(category))
+    for category_id in removed_category_ids:
+        pipe.delete(CATEGORY_KEY.format(category_id))
+    pipe.set(CATEGORIES_INDEX_KEY, json.dumps(index))
+    pipe.set(CATEGORIES_VERSION_KEY, version)
+    pipe.publish(CATALOG_UPDATES_CHANNEL, version)
+    pipe.execute()
+    return [category.get('id') for category in changed_categories]
+
+
+def get_categories_snapshot(db):
+    now = time.monotonic()
+    with _categories_snapshot_lock:
+        if _categories_snapshot['index'] is not None \
+                and now - _categories_snapshot['checked_at'] < CATEGORIES_CHECK_INTERVAL:
+            return _categories_snapshot
+    version = db.get(CATEGORIES_VERSION_KEY)
+    with _categories_snapshot_lock:
+        if version != _categories_snapshot['version'] or _categories_snapshot['index'] is None:
+            _categories_snapshot.update(version=version, index=get_categories_index(db), categories={})
+        _categories_snapshot['checked_at'] = now
+        return _categories_snapshot
+
+
+def get_cached_categories_index(db):
+    return get_categories_snapshot(db)['index']
+
+
+def get_cached_category(db, category_id):
+    categories = get_categories_snapshot(db)['categories']
+    category = categories.get(category_id)
+    if category is None:
+        category = get_category(db, category_id)
+        if category is not None:
+            categories[category_id] = category
+    return category
+
+
+def get_cached_front_page_category(db):
+    return get_cached_category(db, get_cached_categories_index(db)['front_page_category_id'])
+
+
+def invalidate_categories_snapshot():
+    with _categories_snapshot_lock:
+        _categories_snapshot['checked_at'] = 0
+
+
+def start_catalog_listener(db):
+    global _catalog_listener
+    with _categories_snapshot_lock:
+        if _catalog_listener and _catalog_listener.is_alive():
+            return
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CATALOG_UPDATES_CHANNEL: lambda message: invalidate_categories_snapshot()})
+        _catalog_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
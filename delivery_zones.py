@@ -0,0 +1,268 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+from geo_batch import (NO_DELIVERY_TIER, get_coordinates_array,
+                       get_delivery_tiers, get_distance_matrix)
+from geo_helpers import (DELIVERY_TIER_LIMITS_KM, NEAREST_CANDIDATES,
+                         get_delivery_tier)
+from pizzeria_index import EARTH_RADIUS_KM, get_place_index
+
+CELL_SIZE_KM = 0.05
+MAX_CELLS = 4 * 10 ** 6
+KM_PER_DEGREE = 111.195
+GEODESIC_ERROR = 0.007
+REFINE_TIER = -2
+CHUNK_SIZE = 4096
+DELIVERY_ZONES_KEY = 'delivery_zones_{}_{}'
+DELIVERY_ZONES_TTL = 7 * 24 * 60 * 60
+
+logger = logging.getLogger('delivery_zones')
+_delivery_zones = {}
+_delivery_zones_lock = threading.Lock()
+
+
+def get_places_fingerprint(places):
+    places_coordinates = [
+        [place['id'], float(place['latitude']), float(place['longitude'])]
+        for place in places
+    ]
+    return hashlib.sha1(json.dumps(places_coordinates).encode('utf-8')).hexdigest()
+
+
+def get_haversine_km(first_coordinates, second_coordinates):
+    first_latitude, first_longitude = map(math.radians, first_coordinates)
+    second_latitude, second_longitude = map(math.radians, second_coordinates)
+    haversine = (
+        math.sin((second_latitude - first_latitude) / 2) ** 2
+        + math.cos(first_latitude) * math.cos(second_latitude) * math.sin((second_longitude - first_longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(haversine, 1)))
+
+
+def get_grid_geometry(place_coordinates, cell_size_km, max_cells):
+    reach_km = max(DELIVERY_TIER_LIMITS_KM) * (1 + GEODESIC_ERROR) + cell_size_km
+    min_latitude = max(place_coordinates[:, 0].min() - reach_km / KM_PER_DEGREE, -89.0)
+    max_latitude = min(place_coordinates[:, 0].max() + reach_km / KM_PER_DEGREE, 89.0)
+    if min_latitude < 0 < max_latitude:
+        max_cos = 1.0
+    else:
+        max_cos = math.cos(math.radians(min(abs(min_latitude), abs(max_latitude))))
+    min_cos = math.cos(math.radians(max(abs(min_latitude), abs(max_latitude))))
+    longitude_reach = reach_km / (KM_PER_DEGREE * min_cos)
+    min_longitude = place_coordinates[:, 1].min() - longitude_reach
+    max_longitude = place_coordinates[:, 1].max() + longitude_reach
+    while True:
+        latitude_step = cell_size_km / KM_PER_DEGREE
+        longitude_step = latitude_step / math.cos(math.radians((min_latitude + max_latitude) / 2))
+        rows = math.ceil((max_latitude - min_latitude) / latitude_step)
+        columns = math.ceil((max_longitude - min_longitude) / longitude_step)
+        if rows * columns <= max_cells:
+            break
+        cell_size_km *= math.sqrt(rows * columns / max_cells) * 1.01
+    half_diagonal_km = math.hypot(cell_size_km, longitude_step * KM_PER_DEGREE * max_cos) / 2
+    return {
+        'min_latitude': min_latitude,
+        'min_longitude': min_longitude,
+        'latitude_step': latitude_step,
+        'longitude_step': longitude_step,
+        'rows': rows,
+        'columns': columns,
+        'half_diagonal_km': half_diagonal_km,
+    }
+
+
+def build_grid(places, cell_size_km=CELL_SIZE_KM, max_cells=MAX_CELLS, chunk_size=CHUNK_SIZE):
+    place_coordinates = get_coordinates_array(places)
+    geometry = get_grid_geometry(place_coordinates, cell_size_km, max_cells)
+    rows, columns = geometry['rows'], geometry['columns']
+    half_diagonal_km = geometry['half_diagonal_km']
+    center_latitudes = geometry['min_latitude'] + (np.arange(rows) + 0.5) * geometry['latitude_step']
+    center_longitudes = geometry['min_longitude'] + (np.arange(columns) + 0.5) * geometry['longitude_step']
+    place_numbers = np.empty(rows * columns, dtype=np.int32)
+    tiers = np.empty(rows * columns, dtype=np.int8)
+    tier_limits = np.asarray(DELIVERY_TIER_LIMITS_KM, dtype=np.float64)
+    for chunk_start in range(0, rows * columns, chunk_size):
+        cells = np.arange(chunk_start, min(chunk_start + chunk_size, rows * columns))
+        centers = np.column_stack((center_latitudes[cells // columns], center_longitudes[cells % columns]))
+        distance_matrix = get_distance_matrix(centers, place_coordinates)
+        nearest_numbers = np.argmin(distance_matrix, axis=1)
+        nearest_distances = distance_matrix[np.arange(len(cells)), nearest_numbers]
+        if len(places) > 1:
+            second_distances = np.partition(distance_matrix, 1, axis=1)[:, 1]
+        else:
+            second_distances = np.full(len(cells), np.inf)
+        chunk_tiers = get_delivery_tiers(nearest_distances)
+        nearest_place_unclear = (
+            second_distances - nearest_distances
+            <= 2 * half_diagonal_km + second_distances * GEODESIC_ERROR
+        )
+        near_tier_limit = np.any(
+            np.abs(nearest_distances[:, np.newaxis] - tier_limits)
+            <= half_diagonal_km + tier_limits * GEODESIC_ERROR,
+            axis=1,
+        )
+        chunk_tiers[nearest_place_unclear | near_tier_limit] = REFINE_TIER
+        place_numbers[cells] = nearest_numbers
+        tiers[cells] = chunk_tiers
+    return dict(geometry, place_numbers=place_numbers, tiers=tiers)
+
+
+def dump_grid(grid, fingerprint):
+    buffer = io.BytesIO()
+    geometry = [grid[name] for name in ('min_latitude', 'min_longitude', 'latitude_step', 'longitude_step',
+                                        'rows', 'columns', 'half_diagonal_km')]
+    np.savez_compressed(
+        buffer,
+        fingerprint=np.array(fingerprint),
+        geometry=np.array(geometry, dtype=np.float64),
+        place_numbers=grid['place_numbers'],
+        tiers=grid['tiers'],
+    )
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def load_grid(dumped_grid):
+    with np.load(io.BytesIO(base64.b64decode(dumped_grid))) as arrays:
+        min_latitude, min_longitude, latitude_step, longitude_step, rows, columns, half_diagonal_km = \
+            arrays['geometry'].tolist()
+        grid = {
+            'min_latitude': min_latitude,
+            'min_longitude': min_longitude,
+            'latitude_step': latitude_step,
+            'longitude_step': longitude_step,
+            'rows': int(rows),
+            'columns': int(columns),
+            'half_diagonal_km': half_diagonal_km,
+            'place_numbers': arrays['place_numbers'],
+            'tiers': arrays['tiers'],
+        }
+        return str(arrays['fingerprint']), grid
+
+
+class DeliveryZones:
+
+    def __init__(self, place_index, db=None, path=None, cell_size_km=CELL_SIZE_KM):
+        self.place_index = place_index
+        self.db = db
+        self.path = path
+        self.cell_size_km = cell_size_km
+        self.zones, self.fingerprint = (None, None), None
+        self._update_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'grid_hits': 0, 'refined': 0, 'outside_grid': 0, 'not_ready': 0, 'builds': 0, 'loads': 0}
+        place_index.listeners.append(self.schedule_update)
+
+    def update(self, places):
+        with self._update_lock:
+            if places is self.zones[0]:
+                return
+            fingerprint = get_places_fingerprint(places)
+            if fingerprint == self.fingerprint:
+                self.zones = (places, self.zones[1])
+                return
+            grid = self._load_stored_grid(fingerprint) if places else None
+            if grid is None and places:
+                grid = build_grid(places, self.cell_size_km)
+                self._store_grid(grid, fingerprint)
+                self._count('builds')
+                logger.info(f'Сетка зон доставки {self.place_index.flow_slug} построена: '
+                            f'{grid["rows"]}x{grid["columns"]} ячеек')
+            self.zones, self.fingerprint = (places, grid), fingerprint
+
+    def schedule_update(self, places):
+        """Строит сетку в фоне: пока она не готова, get_delivery ищет ближайшую пиццерию по индексу."""
+        threading.Thread(target=self._run_update, args=(places,), daemon=True).start()
+
+    def get_delivery(self, coordinates):
+        self.place_index.ensure_loaded()
+        places, grid = self.zones
+        latitude, longitude = float(coordinates[0]), float(coordinates[1])
+        if grid is not None and places is self.place_index.places:
+            row = math.floor((latitude - grid['min_latitude']) / grid['latitude_step'])
+            column = math.floor((longitude - grid['min_longitude']) / grid['longitude_step'])
+            if 0 <= row < grid['rows'] and 0 <= column < grid['columns']:
+                cell = row * grid['columns'] + column
+                tier = int(grid['tiers'][cell])
+                if tier != REFINE_TIER:
+                    self._count('grid_hits')
+                    place = places[grid['place_numbers'][cell]]
+                    place_distance = get_haversine_km((float(place['latitude']), float(place['longitude'])),
+                                                      (latitude, longitude))
+                    return place, place_distance, None if tier == NO_DELIVERY_TIER else tier
+                self._count('refined')
+            else:
+                self._count('outside_grid')
+        else:
+            self._count('not_ready')
+        place, place_distance = self.place_index.get_nearest((latitude, longitude), k=NEAREST_CANDIDATES)[0]
+        return place, place_distance, get_delivery_tier(place_distance)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['grid_hits'] + stats['refined'] + stats['outside_grid'] + stats['not_ready']
+        stats['grid_hit_ratio'] = stats['grid_hits'] / lookups if lookups else 0
+        return stats
+
+    def _run_update(self, places):
+        if places is not self.place_index.places:
+            return
+        try:
+            self.update(places)
+        except Exception:
+            logger.exception(f'Не удалось построить сетку зон доставки {self.place_index.flow_slug}')
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def _load_stored_grid(self, fingerprint):
+        dumped_grids = []
+        if self.db is not None:
+            dumped_grids.append(self.db.get(DELIVERY_ZONES_KEY.format(self.place_index.flow_slug, fingerprint)))
+        if self.path:
+            try:
+                with open(self.path, 'r') as file:
+                    dumped_grids.append(file.read())
+            except FileNotFoundError:
+                pass
+        for dumped_grid in dumped_grids:
+            if not dumped_grid:
+                continue
+            try:
+                stored_fingerprint, grid = load_grid(dumped_grid)
+            except Exception:
+                logger.exception('Не удалось прочитать сохраненную сетку зон доставки')
+                continue
+            if stored_fingerprint == fingerprint:
+                self._count('loads')
+                return grid
+        return None
+
+    def _store_grid(self, grid, fingerprint):
+        dumped_grid = dump_grid(grid, fingerprint)
+        if self.db is not None:
+            self.db.set(DELIVERY_ZONES_KEY.format(self.place_index.flow_slug, fingerprint), dumped_grid,
+                        ex=DELIVERY_ZONES_TTL)
+        if self.path:
+            with open(f'{self.path}.tmp', 'w') as file:
+                file.write(dumped_grid)
+            os.replace(f'{self.path}.tmp', self.path)
+
+
+def get_delivery_zones(moltin_client_id, moltin_client_secret, flow_slug, db=None, path=None):
+    with _delivery_zones_lock:
+        delivery_zones = _delivery_zones.get(flow_slug)
+        if delivery_zones is None:
+            place_index = get_place_index(moltin_client_id, moltin_client_secret, flow_slug)
+            delivery_zones = DeliveryZones(place_index, db, path)
+            _delivery_zones[flow_slug] = delivery_zones
+    return delivery_zones
@@ -0,0 +1,208 @@
+import json
+import logging
+import threading
+import time
+import uuid
+import zlib
+
+SHARDS = 16
+QUEUE_KEY = 'events_{}_{}'
+PROCESSING_KEY = 'events_{}_{}_processing'
+READY_SHARDS_KEY = 'events_{}_ready'
+SHARD_LEASE_KEY = 'events_{}_{}_lease'
+SHARD_LEASE_TTL = 30
+HEARTBEAT_INTERVAL = SHARD_LEASE_TTL / 3
+WAIT_TIMEOUT = 2
+DRAIN_BATCH_SIZE = 50
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+EXTEND_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+logger = logging.getLogger('event_queue')
+
+
+def get_shard(key, shards=SHARDS):
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def enqueue_events(db, queue_name, keyed_events, shards=SHARDS):
+    enqueued_at = time.time()
+    pipe = db.pipeline(transaction=False)
+    for key, event in keyed_events:
+        shard = get_shard(key, shards)
+        queued_event = json.dumps({'enqueued_at': enqueued_at, 'event': event})
+        pipe.lpush(QUEUE_KEY.format(queue_name, shard), queued_event)
+        pipe.rpush(READY_SHARDS_KEY.format(queue_name), shard)
+    pipe.execute()
+
+
+def get_queue_depths(db, queue_name, shards=SHARDS):
+    pipe = db.pipeline(transaction=False)
+    for shard in range(shards):
+        pipe.llen(QUEUE_KEY.format(queue_name, shard))
+        pipe.llen(PROCESSING_KEY.format(queue_name, shard))
+    lengths = pipe.execute()
+    return [queued + processing for queued, processing in zip(lengths[::2], lengths[1::2])]
+
+
+class EventWorkerPool:
+    """
+    Обработчики очереди событий, разбитой на шарды по ключу. Шард в каждый момент разбирает один поток
+    одного процесса, держащий аренду шарда, поэтому события с одним ключом обрабатываются по порядку.
+    Событие удаляется из Redis только после обработки, а события упавшего процесса обрабатываются заново
+    после истечения его аренды.
+    """
+
+    def __init__(self, db, queue_name, handle_event, workers=4, shards=SHARDS):
+        self.db = db
+        self.queue_name = queue_name
+        self.handle_event = handle_event
+        self.workers = workers
+        self.shards = shards
+        self.worker_id = uuid.uuid4().hex
+        self._release_lease = db.register_script(RELEASE_LEASE_SCRIPT)
+        self._extend_lease = db.register_script(EXTEND_LEASE_SCRIPT)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._leases = {}
+        self._leases_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'processed': 0,
+            'errors': 0,
+            'recovered': 0,
+            'lost_leases': 0,
+            'last_lag_seconds': 0.0,
+            'max_lag_seconds': 0.0,
+            'total_lag_seconds': 0.0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            targets = [self._heartbeat] + [self._run] * self.workers
+            for target in targets:
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        queue_depths = get_queue_depths(self.db, self.queue_name, self.shards)
+        stats['queue_depth'] = sum(queue_depths)
+        stats['busiest_shard_depth'] = max(queue_depths)
+        stats['mean_lag_seconds'] = stats['total_lag_seconds'] / stats['processed'] if stats['processed'] else 0
+        return stats
+
+    def _run(self):
+        ready_shards_key = READY_SHARDS_KEY.format(self.queue_name)
+        while True:
+            try:
+                ready_shard = self.db.blpop(ready_shards_key, timeout=WAIT_TIMEOUT)
+                if ready_shard is not None:
+                    self._drain_shard(int(ready_shard[1]))
+            except Exception:
+                logger.exception('Ошибка обработчика очереди')
+                time.sleep(1)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self._leases_lock:
+                leases = list(self._leases.items())
+            for lease_key, lease_value in leases:
+                try:
+                    extended = self._extend_lease(keys=[lease_key], args=[lease_value, SHARD_LEASE_TTL])
+                except Exception:
+                    logger.exception('Не удалось продлить аренду шарда')
+                    continue
+                if not extended:
+                    logger.warning(f'Аренда {lease_key} потеряна')
+                    with self._leases_lock:
+                        if self._leases.get(lease_key) == lease_value:
+                            del self._leases[lease_key]
+                    self._count('lost_leases')
+            try:
+                self._mark_abandoned_shards()
+            except Exception:
+                logger.exception('Не удалось проверить шарды очереди')
+
+    def _mark_abandoned_shards(self):
+        """Возвращает в список готовых шарды с событиями, которые никто не разбирает, например после падения процесса."""
+        pipe = self.db.pipeline(transaction=False)
+        for shard in range(self.shards):
+            pipe.exists(SHARD_LEASE_KEY.format(self.queue_name, shard))
+        leased = pipe.execute()
+        queue_depths = get_queue_depths(self.db, self.queue_name, self.shards)
+        abandoned_shards = [
+            shard for shard in range(self.shards)
+            if queue_depths[shard] and not leased[shard]
+        ]
+        if abandoned_shards:
+            self.db.rpush(READY_SHARDS_KEY.format(self.queue_name), *abandoned_shards)
+
+    def _drain_shard(self, shard):
+        lease_key = SHARD_LEASE_KEY.format(self.queue_name, shard)
+        lease_value = f'{self.worker_id}:{threading.get_ident()}'
+        if not self.db.set(lease_key, lease_value, nx=True, ex=SHARD_LEASE_TTL):
+            return 0
+        with self._leases_lock:
+            self._leases[lease_key] = lease_value
+        queue_key = QUEUE_KEY.format(self.queue_name, shard)
+        processing_key = PROCESSING_KEY.format(self.queue_name, shard)
+        processed_events = 0
+        try:
+            for queued_event in self.db.lrange(processing_key, 0, -1)[::-1]:
+                self._process_event(json.loads(queued_event))
+                self.db.lrem(processing_key, 1, queued_event)
+                self._count('recovered')
+            while processed_events < DRAIN_BATCH_SIZE and self._holds_lease(lease_key, lease_value):
+                queued_event = self.db.rpoplpush(queue_key, processing_key)
+                if queued_event is None:
+                    break
+                self._process_event(json.loads(queued_event))
+                self.db.lrem(processing_key, 1, queued_event)
+                processed_events += 1
+        finally:
+            with self._leases_lock:
+                if self._leases.get(lease_key) == lease_value:
+                    del self._leases[lease_key]
+            self._release_lease(keys=[lease_key], args=[lease_value])
+            if self.db.llen(queue_key):
+                self.db.rpush(READY_SHARDS_KEY.format(self.queue_name), shard)
+        return processed_events
+
+    def _holds_lease(self, lease_key, lease_value):
+        with self._leases_lock:
+            return self._leases.get(lease_key) == lease_value
+
+    def _process_event(self, queued_event):
+        lag_seconds = time.time() - queued_event['enqueued_at']
+        try:
+            self.handle_event(queued_event['event'])
+            failed = False
+        except Exception:
+            logger.exception('Не удалось обработать событие')
+            failed = True
+        with self._stats_lock:
+            self._stats['processed'] += 1
+            self._stats['errors'] += failed
+            self._stats['last_lag_seconds'] = lag_seconds
+            self._stats['max_lag_seconds'] = max(self._stats['max_lag_seconds'], lag_seconds)
+            self._stats['total_lag_seconds'] += lag_seconds
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
@@ -1,18 +1,27 @@
-import json
-import os
-
-import redis
-import requests
 from environs import Env
-from flask import Flask, request
-
+from flask import Flask, Response, jsonify, request
+
+import state_store
+from cart_helpers import (add_to_cart, get_cached_cart_items, get_cart_stats,
+                          get_product_name, remove_from_cart)
+from catalog_helpers import (get_cached_categories_index, get_cached_category,
+                             get_cached_front_page_category,
+                             start_catalog_listener)
+from event_queue import EventWorkerPool, enqueue_events
 from format_message import get_total_price
-from moltin_helpers import (add_product_to_cart, delete_product_from_cart,
-                            get_cart_items, get_moltin_access_token,
-                            get_product_by_id)
+from messenger_helpers import (GRAPH_API_URL, get_messenger_client,
+                               get_template_message)
+from metrics_helpers import (CONTENT_TYPE, measure, render_metrics,
+                             start_metrics_sync)
+from moltin_helpers import MOLTIN_API_URL, get_moltin_client, get_token_manager
+from state_store import StateStore
+
+EVENTS_QUEUE_NAME = 'facebook'
 
 app = Flask(__name__)
-_database = None
+_settings = None
+_state_store = None
+_event_workers = None
 
 
 @app.route('/', methods=['GET'])
@@ -21,7 +30,7 @@ def verify():
     При верификации вебхука у Facebook он отправит запрос на этот адрес. На него нужно ответить VERIFY_TOKEN.
     """
     if request.args.get('hub.mode') == 'subscribe' and request.args.get('hub.challenge'):
-        if not request.args.get('hub.verify_token') == os.getenv('VERIFY_TOKEN'):
+        if not request.args.get('hub.verify_token') == get_settings()['verify_token']:
             return 'Verification token mismatch', 403
         return request.args['hub.challenge'], 200
 
@@ -32,82 +41,142 @@ def verify():
 def webhook():
     """
     Основной вебхук, на который будут приходить сообщения от Facebook.
+    События складываются в очередь Redis и обрабатываются в фоне, ответ Facebook отправляется сразу.
     """
-    data = request.get_json()
-    if data['object'] == 'page':
-        for entry in data['entry']:
-            for messaging_event in entry['messaging']:
-                if messaging_event.get('message'):
-                    sender_id = messaging_event['sender']['id']
-                    message_text = messaging_event['message']['text']
-                    handle_users_reply(sender_id, message_text=message_text)
-                elif messaging_event.get('postback'):
-                    sender_id = messaging_event['sender']['id']
-                    payload = messaging_event['postback']['payload']
-                    handle_users_reply(sender_id, payload=payload)
+    data = request.get_json(silent=True)
+    if not data or data.get('object') != 'page':
+        return 'ok', 200
+    keyed_events = []
+    for entry in data.get('entry', []):
+        for messaging_event in entry.get('messaging', []):
+            sender_id = messaging_event.get('sender', {}).get('id')
+            if not sender_id:
+                continue
+            if messaging_event.get('message', {}).get('text') or messaging_event.get('postback'):
+                keyed_events.append((sender_id, messaging_event))
+    if keyed_events:
+        enqueue_events(get_database_connection(), EVENTS_QUEUE_NAME, keyed_events)
     return 'ok', 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/queue', methods=['GET'])
+def queue_stats():
+    stats = get_event_workers().get_stats()
+    stats['carts'] = get_cart_stats()
+    return jsonify(stats), 200
+
+
+def handle_messaging_event(messaging_event):
+    sender_id = messaging_event['sender']['id']
+    if messaging_event.get('message'):
+        message_text = messaging_event['message']['text']
+        handle_users_reply(sender_id, message_text=message_text)
+    elif messaging_event.get('postback'):
+        payload = messaging_event['postback']['payload']
+        handle_users_reply(sender_id, payload=payload)
+
+
+def get_event_workers():
+    global _event_workers
+    if _event_workers is None:
+        settings = get_settings()
+        get_moltin_client(base_url=settings['moltin_api_url'])
+        get_messenger_client(settings['facebook_token'], settings['graph_api_url'])
+        db = get_database_connection()
+        start_metrics_sync(db, EVENTS_QUEUE_NAME)
+        get_token_manager(settings['moltin_client_id'], settings['moltin_client_secret'], db).start_background_refresh()
+        start_catalog_listener(db)
+        _event_workers = EventWorkerPool(db, EVENTS_QUEUE_NAME, handle_messaging_event,
+                                         workers=settings['event_workers'])
+    return _event_workers
+
+
+def create_app():
+    get_event_workers().start()
+    return app
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        env = Env()
+        env.read_env()
+        _settings = {
+            'moltin_client_id': env('MOLTIN_CLIENT_ID'),
+            'moltin_client_secret': env('MOLTIN_CLIENT_SECRET'),
+            'facebook_token': env('PAGE_ACCESS_TOKEN'),
+            'verify_token': env('VERIFY_TOKEN', None),
+            'event_workers': env.int('FB_EVENT_WORKERS', 4),
+            'moltin_api_url': env('MOLTIN_API_URL', MOLTIN_API_URL),
+            'graph_api_url': env('GRAPH_API_URL', GRAPH_API_URL),
+            'database_host': env('DATABASE_HOST'),
+            'database_port': env.int('DATABASE_PORT'),
+            'database_password': env('DATABASE_PASSWORD', None),
+        }
+    return _settings
+
+
 def get_database_connection():
-    global _database
-    if _database is None:
-        database_password = os.getenv('DATABASE_PASSWORD')
-        database_host = os.getenv('DATABASE_HOST')
-        database_port = os.getenv('DATABASE_PORT')
-        _database = redis.Redis(host=database_host, port=int(database_port),
-                                password=database_password, decode_responses=True)
-    return _database
+    settings = get_settings()
+    return state_store.get_database_connection(settings['database_host'], settings['database_port'],
+                                               settings['database_password'])
+
+
+def get_state_store():
+    global _state_store
+    if _state_store is None:
+        _state_store = StateStore(get_database_connection(), 'facebook_id_{}', default_state='START', cache_size=0)
+    return _state_store
 
 
 def handle_users_reply(sender_id, message_text=None, payload=None):
-    env = Env()
-    env.read_env()
-    moltin_client_id = env('MOLTIN_CLIENT_ID')
-    moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
-    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
-    facebook_token = env('PAGE_ACCESS_TOKEN')
+    settings = get_settings()
+    facebook_token = settings['facebook_token']
     db = get_database_connection()
+    token_manager = get_token_manager(settings['moltin_client_id'], settings['moltin_client_secret'], db)
+    moltin_access_token = token_manager.get_token()
     if message_text:
         user_state = 'START'
     else:
-        user_state = db.get(f'facebook_id_{sender_id}')
+        user_state = get_state_store().get_state(sender_id)
     states_functions = {
         'START': handle_menu,
         'CART': handle_cart,
     }
     state_handler = states_functions[user_state]
-    next_state = state_handler(sender_id, message_text, payload, db, moltin_access_token, facebook_token)
-    db.set(f'facebook_id_{sender_id}', next_state)
+    with measure('state_handler', bot='facebook', state=user_state):
+        next_state = state_handler(sender_id, message_text, payload, db, moltin_access_token, facebook_token)
+    get_state_store().set_state(sender_id, next_state)
 
 
 def handle_menu(recipient_id, message_text, payload, db, moltin_access_token, facebook_token):
     if payload:
         button_name, some_id = payload.split(';')
         if button_name == 'Категория':
-            categories = json.loads(db.get('categories'))
             category_id = some_id
-            current_category = None
-            for category in categories:
-                if category.get('id') == category_id:
-                    current_category = category
-                    break
+            current_category = get_cached_category(db, category_id)
             pizzas = current_category.get('products')
         elif button_name == 'Добавить в корзину':
             product_id = some_id
-            add_product_to_cart(moltin_access_token, product_id, recipient_id)
-            pizza = get_product_by_id(moltin_access_token, product_id)
-            message = f'В корзину добавлена пицца - {pizza.get("name")}'
+            cart_pizzas = add_to_cart(db, moltin_access_token, product_id, recipient_id)
+            pizza_name = get_product_name(db, moltin_access_token, cart_pizzas, product_id)
+            message = f'В корзину добавлена пицца - {pizza_name}'
             send_message(recipient_id, message, facebook_token)
             return 'START'
         elif button_name == 'Корзина':
             handle_cart(recipient_id, message_text, payload, db, moltin_access_token, facebook_token)
             return 'CART'
         else:
-            front_page_category = json.loads(db.get('menu'))
+            front_page_category = get_cached_front_page_category(db)
             category_id = front_page_category.get('id')
             pizzas = front_page_category.get('products')
     else:
-        front_page_category = json.loads(db.get('menu'))
+        front_page_category = get_cached_front_page_category(db)
         category_id = front_page_category.get('id')
         pizzas = front_page_category.get('products')
 
@@ -118,37 +187,17 @@ def handle_menu(recipient_id, message_text, payload, db, moltin_access_token, fa
         product_card = get_product_card(pizza)
         menu_cards.append(product_card)
 
-    categories = json.loads(db.get('categories'))
+    categories = get_cached_categories_index(db)['categories']
     categories_card = get_categories_card(categories, category_id)
     menu_cards.append(categories_card)
 
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'recipient': {
-            'id': recipient_id,
-        },
-        'message': {
-            'attachment': {
-                'type': 'template',
-                'payload': {
-                    'template_type': 'generic',
-                    'elements': menu_cards,
-                },
-            },
-        },
-    }
-    response = requests.post(
-        f'https://graph.facebook.com/v2.6/me/messages?access_token={facebook_token}',
-        headers=headers,
-        json=payload,
-    )
-    response.raise_for_status()
+    get_messenger_client(facebook_token).send_template(recipient_id, menu_cards)
     return 'START'
 
 
 def handle_cart(recipient_id, message_text, payload, db, moltin_access_token, facebook_token):
+    messages = []
+    cart_pizzas = None
     if payload:
         button_name, some_id = payload.split(';')
         if button_name == 'В меню':
@@ -156,45 +205,23 @@ def handle_cart(recipient_id, message_text, payload, db, moltin_access_token, fa
             return 'START'
         elif button_name == 'Убрать из корзины':
             product_id = some_id
-            delete_product_from_cart(moltin_access_token, recipient_id, product_id)
-            message = f'Пицца удалена из корзины'
-            send_message(recipient_id, message, facebook_token)
+            cart_pizzas = remove_from_cart(db, moltin_access_token, recipient_id, product_id)
+            messages.append({'text': 'Пицца удалена из корзины'})
         elif button_name == 'Добавить ещё одну':
             product_id = some_id
-            add_product_to_cart(moltin_access_token, product_id, recipient_id)
-            pizza_name = get_product_by_id(moltin_access_token, product_id).get('name')
-            message = f'В корзину добавлен еще одна пицца - {pizza_name}'
-            send_message(recipient_id, message, facebook_token)
-    cart_pizzas = get_cart_items(moltin_access_token, recipient_id)
+            cart_pizzas = add_to_cart(db, moltin_access_token, product_id, recipient_id)
+            pizza_name = get_product_name(db, moltin_access_token, cart_pizzas, product_id)
+            messages.append({'text': f'В корзину добавлен еще одна пицца - {pizza_name}'})
+    if cart_pizzas is None:
+        cart_pizzas = get_cached_cart_items(db, moltin_access_token, recipient_id)
     cart_cards = [get_cart_main_card(cart_pizzas), ]
     if cart_pizzas:
         for pizza in cart_pizzas:
             product_card = get_product_cart_card(pizza)
             cart_cards.append(product_card)
 
-    headers = {
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'recipient': {
-            'id': recipient_id,
-        },
-        'message': {
-            'attachment': {
-                'type': 'template',
-                'payload': {
-                    'template_type': 'generic',
-                    'elements': cart_cards,
-                },
-            },
-        },
-    }
-    response = requests.post(
-        f'https://graph.facebook.com/v2.6/me/messages?access_token={facebook_token}',
-        headers=headers,
-        json=payload,
-    )
-    response.raise_for_status()
+    messages.append(get_template_message(cart_cards))
+    get_messenger_client(facebook_token).send_messages(recipient_id, messages)
     return 'CART'
 
 
@@ -313,22 +340,8 @@ def get_categories_card(categories, category_id):
 
 
 def send_message(recipient_id, message_text, facebook_token):
-    params = {'access_token': facebook_token}
-    headers = {'Content-Type': 'application/json'}
-    request_content = {
-        'recipient': {
-            'id': recipient_id
-        },
-        'message': {
-            'text': message_text
-        }
-    }
-    response = requests.post(
-        'https://graph.facebook.com/v2.6/me/messages',
-        params=params, headers=headers, json=request_content
-    )
-    response.raise_for_status()
+    get_messenger_client(facebook_token).send_text(recipient_id, message_text)
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True, use_reloader=False)
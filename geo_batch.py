@@ -0,0 +1,66 @@
+import numpy as np
+from geopy import distance
+
+from geo_helpers import DELIVERY_TIER_LIMITS_KM, NEAREST_CANDIDATES
+from pizzeria_index import EARTH_RADIUS_KM
+
+NO_DELIVERY_TIER = -1
+CHUNK_SIZE = 4096
+
+
+def get_coordinates_array(places):
+    return np.array(
+        [(float(place['latitude']), float(place['longitude'])) for place in places],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+
+
+def get_distance_matrix(customer_coordinates, place_coordinates):
+    customer_coordinates = np.radians(np.asarray(customer_coordinates, dtype=np.float64).reshape(-1, 2))
+    place_coordinates = np.radians(np.asarray(place_coordinates, dtype=np.float64).reshape(-1, 2))
+    customer_latitudes = customer_coordinates[:, 0, np.newaxis]
+    customer_longitudes = customer_coordinates[:, 1, np.newaxis]
+    place_latitudes, place_longitudes = place_coordinates[:, 0], place_coordinates[:, 1]
+    haversine = (
+        np.sin((place_latitudes - customer_latitudes) / 2) ** 2
+        + np.cos(customer_latitudes) * np.cos(place_latitudes)
+        * np.sin((place_longitudes - customer_longitudes) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def get_delivery_tiers(distances):
+    distances = np.asarray(distances, dtype=np.float64)
+    tiers = np.searchsorted(np.asarray(DELIVERY_TIER_LIMITS_KM), distances, side='left')
+    return np.where(tiers < len(DELIVERY_TIER_LIMITS_KM), tiers, NO_DELIVERY_TIER)
+
+
+def get_nearest_places(customer_coordinates, place_coordinates, refine=False, chunk_size=CHUNK_SIZE):
+    customer_coordinates = np.asarray(customer_coordinates, dtype=np.float64).reshape(-1, 2)
+    place_coordinates = np.asarray(place_coordinates, dtype=np.float64).reshape(-1, 2)
+    place_numbers = np.empty(len(customer_coordinates), dtype=np.int64)
+    distances = np.empty(len(customer_coordinates), dtype=np.float64)
+    candidates_count = min(NEAREST_CANDIDATES, len(place_coordinates))
+    for chunk_start in range(0, len(customer_coordinates), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        distance_matrix = get_distance_matrix(customer_coordinates[chunk], place_coordinates)
+        if not refine:
+            place_numbers[chunk] = np.argmin(distance_matrix, axis=1)
+            distances[chunk] = distance_matrix[np.arange(len(distance_matrix)), place_numbers[chunk]]
+            continue
+        candidates = np.argpartition(distance_matrix, candidates_count - 1, axis=1)[:, :candidates_count]
+        for customer_number, place_candidates in enumerate(candidates, start=chunk_start):
+            candidate_distances = [
+                distance.distance(customer_coordinates[customer_number], place_coordinates[place_number]).km
+                for place_number in place_candidates
+            ]
+            best_candidate = int(np.argmin(candidate_distances))
+            place_numbers[customer_number] = place_candidates[best_candidate]
+            distances[customer_number] = candidate_distances[best_candidate]
+    return place_numbers, distances, get_delivery_tiers(distances)
+
+
+def get_nearest_place_ids(customer_coordinates, places, refine=False):
+    place_numbers, distances, tiers = get_nearest_places(customer_coordinates, get_coordinates_array(places), refine)
+    place_ids = np.array([place['id'] for place in places], dtype=object)
+    return place_ids[place_numbers], distances, tiers
@@ -1,17 +1,66 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
 import requests
-from geopy import distance
 
-from moltin_helpers import get_all_entries, get_moltin_access_token
+from metrics_helpers import measure
+from pizzeria_index import get_place_index
+
+NEAREST_CANDIDATES = 3
+DELIVERY_TIER_LIMITS_KM = (0.5, 5, 20)
+GEOCODER_TIMEOUT = 10
+GEOCODE_KEY = 'geocode_{}'
+GEOCODE_TTL = 30 * 24 * 60 * 60
+GEOCODE_NEGATIVE_TTL = 24 * 60 * 60
+GEOCODE_LOCAL_CACHE_SIZE = 4096
+ADDRESS_ABBREVIATIONS = (
+    (r'\bг\.\s*', 'город '),
+    (r'\bул\.\s*', 'улица '),
+    (r'\bпр-т\b\.?\s*', 'проспект '),
+    (r'\bпросп\.\s*', 'проспект '),
+    (r'\bпер\.\s*', 'переулок '),
+    (r'\bнаб\.\s*', 'набережная '),
+    (r'\bш\.\s*', 'шоссе '),
+    (r'\bпл\.\s*', 'площадь '),
+    (r'\bб-р\b\.?\s*', 'бульвар '),
+    (r'(?<![\w-])д\.\s*', 'дом '),
+    (r'\bкорп\.\s*', 'корпус '),
+    (r'\bстр\.\s*', 'строение '),
+)
+
+_geocode_cache = OrderedDict()
+_geocode_lookups = {}
+_geocode_lock = threading.Lock()
+_geocode_stats = {
+    'local_hits': 0,
+    'redis_hits': 0,
+    'misses': 0,
+    'negative_results': 0,
+    'deduplicated': 0,
+}
+
 
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    for pattern, replacement in ADDRESS_ABBREVIATIONS:
+        address = re.sub(pattern, replacement, address)
+    address = re.sub(r'[,;]+', ' ', address)
+    return ' '.join(address.split())
 
-def fetch_coordinates(apikey, address):
+
+def request_coordinates(apikey, address):
     base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
-    response.raise_for_status()
+    with measure('upstream', service='yandex_geocoder', call='geocode'):
+        response = requests.get(base_url, params={
+            "geocode": address,
+            "apikey": apikey,
+            "format": "json",
+        }, timeout=GEOCODER_TIMEOUT)
+        response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
     if not found_places:
@@ -22,10 +71,83 @@ def fetch_coordinates(apikey, address):
     return lat, lon
 
 
+def fetch_coordinates(apikey, address, db=None):
+    normalized_address = normalize_address(address)
+    with _geocode_lock:
+        cached_coordinates, expires_at = _geocode_cache.get(normalized_address, (None, 0))
+        if expires_at > time.monotonic():
+            _geocode_cache.move_to_end(normalized_address)
+            _geocode_stats['local_hits'] += 1
+            return cached_coordinates
+        _geocode_cache.pop(normalized_address, None)
+        lookup = _geocode_lookups.get(normalized_address)
+        is_leader = lookup is None
+        if is_leader:
+            lookup = {'done': threading.Event(), 'coordinates': None, 'error': None}
+            _geocode_lookups[normalized_address] = lookup
+        else:
+            _geocode_stats['deduplicated'] += 1
+    if not is_leader:
+        lookup['done'].wait()
+        if lookup['error']:
+            raise lookup['error']
+        return lookup['coordinates']
+    try:
+        coordinates, ttl = get_cached_coordinates(apikey, address, normalized_address, db)
+        lookup['coordinates'] = coordinates
+        with _geocode_lock:
+            _geocode_cache[normalized_address] = (coordinates, time.monotonic() + ttl)
+            while len(_geocode_cache) > GEOCODE_LOCAL_CACHE_SIZE:
+                _geocode_cache.popitem(last=False)
+        return coordinates
+    except Exception as error:
+        lookup['error'] = error
+        raise
+    finally:
+        with _geocode_lock:
+            _geocode_lookups.pop(normalized_address, None)
+        lookup['done'].set()
+
+
+def get_cached_coordinates(apikey, address, normalized_address, db):
+    geocode_key = GEOCODE_KEY.format(hashlib.sha1(normalized_address.encode('utf-8')).hexdigest())
+    if db is not None:
+        pipe = db.pipeline(transaction=False)
+        pipe.get(geocode_key)
+        pipe.ttl(geocode_key)
+        cached_coordinates, cached_ttl = pipe.execute()
+        if cached_coordinates and cached_ttl > 0:
+            with _geocode_lock:
+                _geocode_stats['redis_hits'] += 1
+            cached_coordinates = json.loads(cached_coordinates)
+            return (tuple(cached_coordinates) if cached_coordinates else None), cached_ttl
+    coordinates = request_coordinates(apikey, address)
+    with _geocode_lock:
+        _geocode_stats['misses'] += 1
+        if not coordinates:
+            _geocode_stats['negative_results'] += 1
+    geocode_ttl = GEOCODE_TTL if coordinates else GEOCODE_NEGATIVE_TTL
+    if db is not None:
+        db.set(geocode_key, json.dumps(coordinates), ex=geocode_ttl)
+    return coordinates, geocode_ttl
+
+
+def get_geocode_stats():
+    with _geocode_lock:
+        stats = dict(_geocode_stats)
+    lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+    stats['hit_ratio'] = (stats['local_hits'] + stats['redis_hits']) / lookups if lookups else 0
+    return stats
+
+
 def get_nearest_place(coordinates, moltin_client_id, moltin_client_secret, flow_slug):
-    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
-    pizzerias = get_all_entries(moltin_access_token, flow_slug)
-    nearest_place = min(
-        pizzerias,
-        key=lambda pizzeria: distance.distance((pizzeria['latitude'], pizzeria['longitude']), coordinates).km)
-    return nearest_place
+    place_index = get_place_index(moltin_client_id, moltin_client_secret, flow_slug)
+    nearest_place, place_distance = place_index.get_nearest(coordinates, k=NEAREST_CANDIDATES)[0]
+    return nearest_place, place_distance
+
+
+def get_delivery_tier(distance_km):
+    for tier, tier_limit in enumerate(DELIVERY_TIER_LIMITS_KM):
+        if distance_km <= tier_limit:
+            return tier
+    return None
@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+from moltin_helpers import get_image_by_id, iter_images
+
+IMAGE_HREF_KEY = 'image_href_{}'
+IMAGE_HREF_TTL = 7 * 24 * 60 * 60
+LOCAL_CACHE_SIZE = 512
+
+_image_hrefs = OrderedDict()
+_image_hrefs_lock = threading.Lock()
+
+
+def remember_image_href(image_id, href):
+    with _image_hrefs_lock:
+        _image_hrefs[image_id] = href
+        _image_hrefs.move_to_end(image_id)
+        while len(_image_hrefs) > LOCAL_CACHE_SIZE:
+            _image_hrefs.popitem(last=False)
+
+
+def warm_up_image_cache(db, moltin_access_token):
+    image_hrefs = {}
+    pipe = db.pipeline(transaction=False)
+    for image in iter_images(moltin_access_token, prefetch=True):
+        image_id, href = image.get('id'), image.get('link').get('href')
+        image_hrefs[image_id] = href
+        pipe.set(IMAGE_HREF_KEY.format(image_id), href, ex=IMAGE_HREF_TTL)
+        remember_image_href(image_id, href)
+    pipe.execute()
+    return image_hrefs
+
+
+def get_image_href(db, moltin_access_token, image_id):
+    with _image_hrefs_lock:
+        href = _image_hrefs.get(image_id)
+        if href:
+            _image_hrefs.move_to_end(image_id)
+            return href
+    href = db.get(IMAGE_HREF_KEY.format(image_id))
+    if not href:
+        image = get_image_by_id(moltin_access_token, image_id)
+        href = image.get('link').get('href')
+        db.set(IMAGE_HREF_KEY.format(image_id), href, ex=IMAGE_HREF_TTL)
+    remember_image_href(image_id, href)
+    return href
@@ -1,13 +1,128 @@
 import logging
+import queue
+import sys
+import threading
+import time
+
+MESSAGE_LIMIT = 4096
+QUEUE_SIZE = 1000
+SEND_INTERVAL = 3
+DEDUPE_WINDOW = 60
+POLL_INTERVAL = 1
+CLOSE_TIMEOUT = 10
 
 
 class TelegramLogsHandler(logging.Handler):
 
-    def __init__(self, tg_bot, chat_id):
+    def __init__(self, tg_bot, chat_id, send_interval=SEND_INTERVAL, dedupe_window=DEDUPE_WINDOW,
+                 queue_size=QUEUE_SIZE):
         super().__init__()
         self.chat_id = chat_id
         self.tg_bot = tg_bot
+        self.send_interval = send_interval
+        self.dedupe_window = dedupe_window
+        self.log_entries = queue.Queue(maxsize=queue_size)
+        self.dropped_entries = 0
+        self._sent_entries = {}
+        self._sent_at = 0
+        self._stopping = threading.Event()
+        self._sender = threading.Thread(target=self._run, daemon=True)
+        self._sender.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
+        try:
+            self.log_entries.put_nowait(self.format(record))
+        except queue.Full:
+            self.dropped_entries += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self, timeout=CLOSE_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while self.log_entries.unfinished_tasks and self._sender.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def close(self):
+        self._stopping.set()
+        self._sender.join(CLOSE_TIMEOUT)
+        super().close()
+
+    def _run(self):
+        while True:
+            log_entries = self._collect_entries()
+            messages = self._get_messages(log_entries)
+            for message in messages:
+                self._send_message(message)
+            for _ in log_entries:
+                self.log_entries.task_done()
+            if self._stopping.is_set() and not log_entries and self.log_entries.empty():
+                return
+
+    def _collect_entries(self):
+        try:
+            log_entries = [self.log_entries.get(timeout=POLL_INTERVAL)]
+        except queue.Empty:
+            return []
+        while not self._stopping.is_set() and time.monotonic() - self._sent_at < self.send_interval:
+            time.sleep(0.1)
+        while True:
+            try:
+                log_entries.append(self.log_entries.get_nowait())
+            except queue.Empty:
+                return log_entries
+
+    def _get_messages(self, log_entries):
+        now = time.monotonic()
+        entry_counts = {}
+        for log_entry in log_entries:
+            entry_counts[log_entry] = entry_counts.get(log_entry, 0) + 1
+
+        texts = []
+        if self.dropped_entries:
+            texts.append(f'Очередь логов переполнена, пропущено сообщений: {self.dropped_entries}')
+            self.dropped_entries = 0
+        for log_entry, (sent_at, suppressed_count) in list(self._sent_entries.items()):
+            if now - sent_at < self.dedupe_window or log_entry in entry_counts:
+                continue
+            if suppressed_count:
+                texts.append(f'{log_entry}\n\nПовторилось ещё {suppressed_count} раз(а)')
+            del self._sent_entries[log_entry]
+        for log_entry, count in entry_counts.items():
+            sent_at, suppressed_count = self._sent_entries.get(log_entry, (None, 0))
+            if sent_at is not None and now - sent_at < self.dedupe_window:
+                self._sent_entries[log_entry] = (sent_at, suppressed_count + count)
+                continue
+            count += suppressed_count
+            self._sent_entries[log_entry] = (now, 0)
+            texts.append(f'{log_entry}\n\nПовторилось {count} раз(а)' if count > 1 else log_entry)
+        return split_message(texts)
+
+    def _send_message(self, message):
+        while not self._stopping.is_set() and time.monotonic() - self._sent_at < self.send_interval:
+            time.sleep(0.1)
+        for _ in range(2):
+            try:
+                self.tg_bot.send_message(chat_id=self.chat_id, text=message)
+                break
+            except Exception as error:
+                retry_after = getattr(error, 'retry_after', None)
+                if not retry_after or self._stopping.is_set():
+                    sys.stderr.write(f'Не удалось отправить лог в Telegram: {error}\n')
+                    break
+                time.sleep(retry_after)
+        self._sent_at = time.monotonic()
+
+
+def split_message(texts, limit=MESSAGE_LIMIT):
+    messages = []
+    message = ''
+    for text in texts:
+        if len(text) > limit:
+            text = f'…{text[-limit + 1:]}'
+        if message and len(message) + len(text) + 2 > limit:
+            messages.append(message)
+            message = ''
+        message = f'{message}\n\n{text}' if message else text
+    if message:
+        messages.append(message)
+    return messages
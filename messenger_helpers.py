@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics_helpers import measure
+from moltin_helpers import call_with_retry, is_unsent_request_error
+from rate_limit_helpers import TokenBucket
+
+GRAPH_API_URL = 'https://graph.facebook.com'
+GRAPH_API_VERSION = 'v2.6'
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_RATE = 250
+DEFAULT_BURST = 250
+RETRY_ATTEMPTS = 3
+
+_messenger_clients = {}
+_messenger_clients_lock = threading.Lock()
+
+
+class MessengerClient:
+
+    def __init__(self, page_token, base_url=GRAPH_API_URL, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.params = {'access_token': page_token}
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.rate_limiter = TokenBucket(rate, burst)
+        self._stats = {'calls': 0, 'messages': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+        self._stats_lock = threading.Lock()
+
+    def send_text(self, recipient_id, message_text):
+        return self.send_messages(recipient_id, [{'text': message_text}])
+
+    def send_template(self, recipient_id, elements):
+        return self.send_messages(recipient_id, [get_template_message(elements)])
+
+    def send_messages(self, recipient_id, messages, pipeline=True):
+        if len(messages) == 1 or not pipeline:
+            return [self._post_message(recipient_id, message) for message in messages]
+        return self._post_batch(recipient_id, messages)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['mean_seconds'] = stats['total_seconds'] / stats['calls'] if stats['calls'] else 0
+        return stats
+
+    def _post_message(self, recipient_id, message):
+        payload = {
+            'recipient': {
+                'id': recipient_id,
+            },
+            'message': message,
+        }
+        url = f'{self.base_url}/{GRAPH_API_VERSION}/me/messages'
+        response = self._request(1, url, json=payload)
+        return response.json()
+
+    def _post_batch(self, recipient_id, messages):
+        batch = []
+        for message_number, message in enumerate(messages):
+            batch_request = {
+                'method': 'POST',
+                'name': f'message_{message_number}',
+                'relative_url': f'{GRAPH_API_VERSION}/me/messages',
+                'body': urlencode({
+                    'recipient': json.dumps({'id': recipient_id}),
+                    'message': json.dumps(message, ensure_ascii=False),
+                }),
+            }
+            if message_number:
+                batch_request['depends_on'] = f'message_{message_number - 1}'
+            batch.append(batch_request)
+        response = self._request(len(messages), self.base_url, data={'batch': json.dumps(batch)})
+        results = response.json()
+        for result in results:
+            if result and result.get('code', 200) >= 400:
+                raise requests.HTTPError(f'Graph API batch error: {result.get("body")}', response=response)
+        return [json.loads(result['body']) if result and result.get('body') else None for result in results]
+
+    def _request(self, messages_count, url, **kwargs):
+        self.rate_limiter.acquire(messages_count)
+        started_at = time.perf_counter()
+        try:
+            with measure('upstream', service='graph', call='batch' if url == self.base_url else 'messages'):
+                return call_with_retry(self._post, url, attempts=RETRY_ATTEMPTS, is_retryable=is_unsent_request_error,
+                                       **kwargs)
+        except requests.RequestException:
+            with self._stats_lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            elapsed_seconds = time.perf_counter() - started_at
+            with self._stats_lock:
+                self._stats['calls'] += 1
+                self._stats['messages'] += messages_count
+                self._stats['total_seconds'] += elapsed_seconds
+                self._stats['max_seconds'] = max(self._stats['max_seconds'], elapsed_seconds)
+
+    def _post(self, url, **kwargs):
+        response = self.session.post(url, params=self.params, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+
+def get_template_message(elements):
+    return {
+        'attachment': {
+            'type': 'template',
+            'payload': {
+                'template_type': 'generic',
+                'elements': elements,
+            },
+        },
+    }
+
+
+def get_messenger_client(page_token, base_url=GRAPH_API_URL):
+    with _messenger_clients_lock:
+        messenger_client = _messenger_clients.get(page_token)
+        if messenger_client is None:
+            messenger_client = MessengerClient(page_token, base_url)
+            _messenger_clients[page_token] = messenger_client
+    return messenger_client
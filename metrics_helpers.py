@@ -0,0 +1,252 @@
+import bisect
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = 'pizza_bot'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_KEY = 'metrics_{}'
+METRICS_IN_FLIGHT_KEY = 'metrics_{}_in_flight'
+METRICS_HEARTBEATS_KEY = 'metrics_{}_heartbeats'
+METRICS_SYNC_INTERVAL = 5
+METRICS_WORKER_TIMEOUT = 3 * METRICS_SYNC_INTERVAL
+
+logger = logging.getLogger('metrics_helpers')
+_histograms = {}
+_errors = {}
+_in_flight = {}
+_metrics_lock = threading.Lock()
+_metrics_server = None
+_metrics_sync = None
+
+
+def get_labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(metric, seconds, **labels):
+    with _metrics_lock:
+        record_latency((metric, get_labels_key(labels)), seconds)
+
+
+def record_latency(key, seconds):
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+    histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+class Measurement:
+    __slots__ = ('key', 'started_at')
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        with _metrics_lock:
+            _in_flight[self.key] = _in_flight.get(self.key, 0) + 1
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        seconds = time.perf_counter() - self.started_at
+        with _metrics_lock:
+            _in_flight[self.key] -= 1
+            if error_type is not None:
+                _errors[self.key] = _errors.get(self.key, 0) + 1
+            record_latency(self.key, seconds)
+        return False
+
+
+def measure(metric, **labels):
+    return Measurement((metric, get_labels_key(labels)))
+
+
+def format_labels(labels_key, **extra_labels):
+    labels = list(labels_key) + list(extra_labels.items())
+    if not labels:
+        return ''
+    formatted_labels = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted_labels.append(f'{name}="{value}"')
+    return '{' + ','.join(formatted_labels) + '}'
+
+
+def get_local_metrics():
+    with _metrics_lock:
+        histograms = {
+            key: dict(histogram, buckets=list(histogram['buckets']))
+            for key, histogram in _histograms.items()
+        }
+        return histograms, dict(_errors), dict(_in_flight)
+
+
+def render_metrics():
+    if _metrics_sync is not None:
+        return format_metrics(*_metrics_sync.get_metrics())
+    return format_metrics(*get_local_metrics())
+
+
+def format_metrics(histograms, errors, in_flight):
+    lines = []
+    for metric in sorted({metric for metric, _ in histograms}):
+        name = f'{METRICS_PREFIX}_{metric}_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for (histogram_metric, labels_key), histogram in sorted(histograms.items()):
+            if histogram_metric != metric:
+                continue
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative_count += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels_key, le=upper_bound)} {cumulative_count}')
+            lines.append(f'{name}_bucket{format_labels(labels_key, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels_key)} {histogram["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels_key)} {histogram["count"]}')
+    for suffix, metric_type, values in (('errors_total', 'counter', errors), ('in_flight', 'gauge', in_flight)):
+        for metric in sorted({metric for metric, _ in values}):
+            name = f'{METRICS_PREFIX}_{metric}_{suffix}'
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (values_metric, labels_key), value in sorted(values.items()):
+                if values_metric == metric:
+                    lines.append(f'{name}{format_labels(labels_key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+
+def get_field(*parts):
+    return json.dumps(parts, ensure_ascii=False)
+
+
+class MetricsSync:
+    """
+    Складывает метрики всех процессов в хеш Redis, чтобы каждый процесс gunicorn отдавал по `/metrics` общие значения.
+    Процесс раз в METRICS_SYNC_INTERVAL секунд добавляет в хеш свои приращения гистограмм и ошибок
+    и записывает изменившееся число запросов в работе. Если ничего не изменилось и запросов в работе нет,
+    в Redis ничего не отправляется.
+    """
+
+    def __init__(self, db, namespace):
+        self.db = db
+        self.metrics_key = METRICS_KEY.format(namespace)
+        self.in_flight_key = METRICS_IN_FLIGHT_KEY.format(namespace)
+        self.heartbeats_key = METRICS_HEARTBEATS_KEY.format(namespace)
+        self.worker_id = uuid.uuid4().hex
+        self._synced_histograms = {}
+        self._synced_errors = {}
+        self._synced_in_flight = {}
+        self._sync_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def sync(self):
+        with self._sync_lock:
+            histograms, errors, in_flight = get_local_metrics()
+            pipe = self.db.pipeline(transaction=False)
+            for (metric, labels_key), histogram in histograms.items():
+                synced = self._synced_histograms.get((metric, labels_key))
+                for bucket_number, bucket_count in enumerate(histogram['buckets']):
+                    delta = bucket_count - (synced['buckets'][bucket_number] if synced else 0)
+                    if delta:
+                        pipe.hincrby(self.metrics_key, get_field('bucket', metric, labels_key, bucket_number), delta)
+                if histogram['count'] != (synced['count'] if synced else 0):
+                    pipe.hincrby(self.metrics_key, get_field('count', metric, labels_key),
+                                 histogram['count'] - (synced['count'] if synced else 0))
+                    pipe.hincrbyfloat(self.metrics_key, get_field('sum', metric, labels_key),
+                                      histogram['sum'] - (synced['sum'] if synced else 0))
+            for (metric, labels_key), count in errors.items():
+                delta = count - self._synced_errors.get((metric, labels_key), 0)
+                if delta:
+                    pipe.hincrby(self.metrics_key, get_field('errors', metric, labels_key), delta)
+            for (metric, labels_key), count in in_flight.items():
+                if count != self._synced_in_flight.get((metric, labels_key)):
+                    pipe.hset(self.in_flight_key, get_field(self.worker_id, metric, labels_key), count)
+            if not len(pipe) and not any(in_flight.values()):
+                return
+            pipe.hset(self.heartbeats_key, self.worker_id, time.time())
+            pipe.execute()
+            self._synced_histograms, self._synced_errors, self._synced_in_flight = histograms, errors, in_flight
+
+    def get_metrics(self):
+        self.sync()
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hgetall(self.metrics_key)
+        pipe.hgetall(self.in_flight_key)
+        pipe.hgetall(self.heartbeats_key)
+        metrics, in_flight_fields, heartbeats = pipe.execute()
+
+        histograms, errors = {}, {}
+        for field, value in metrics.items():
+            kind, metric, labels_key, *bucket_number = json.loads(field)
+            key = (metric, tuple(tuple(label) for label in labels_key))
+            if kind == 'errors':
+                errors[key] = int(value)
+                continue
+            histogram = histograms.setdefault(
+                key,
+                {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0},
+            )
+            if kind == 'bucket':
+                histogram['buckets'][bucket_number[0]] = int(value)
+            else:
+                histogram[kind] = float(value) if kind == 'sum' else int(value)
+
+        in_flight, stale_fields = {}, []
+        alive_after = time.time() - METRICS_WORKER_TIMEOUT
+        for field, value in in_flight_fields.items():
+            worker_id, metric, labels_key = json.loads(field)
+            if float(heartbeats.get(worker_id) or 0) < alive_after:
+                stale_fields.append(field)
+                continue
+            key = (metric, tuple(tuple(label) for label in labels_key))
+            in_flight[key] = in_flight.get(key, 0) + int(value)
+        if stale_fields:
+            self.db.hdel(self.in_flight_key, *stale_fields)
+        return histograms, errors, in_flight
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_SYNC_INTERVAL)
+            try:
+                self.sync()
+            except Exception:
+                logger.exception('Не удалось сохранить метрики в Redis')
+
+
+def start_metrics_sync(db, namespace):
+    global _metrics_sync
+    if _metrics_sync is None:
+        _metrics_sync = MetricsSync(db, namespace).start()
+    return _metrics_sync
@@ -1,36 +1,368 @@
-from datetime import datetime
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
 
 import requests
+from redis.exceptions import LockNotOwnedError
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
 
-MOLTIN_ACCESS_TOKEN, TOKEN_CREATED_AT = None, None
+from metrics_helpers import measure
 
+MOLTIN_API_URL = 'https://api.moltin.com'
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = (3.05, 15)
+TOKEN_REFRESH_MARGIN = 30
+TOKEN_BACKGROUND_REFRESH_MARGIN = 120
+TOKEN_LOCK_MARGIN = 5
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+PAGE_SIZE = 100
+PREFETCH_WORKERS = 4
 
-def get_moltin_access_token(client_id, client_secret):
-    global MOLTIN_ACCESS_TOKEN, TOKEN_CREATED_AT
-    if MOLTIN_ACCESS_TOKEN:
-        left_time = TOKEN_CREATED_AT - datetime.now().timestamp()
-        minimum_seconds = 30
-        if left_time > minimum_seconds:
-            return MOLTIN_ACCESS_TOKEN
-    data = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials',
-    }
-    response = requests.post('https://api.moltin.com/oauth/access_token', data=data)
-    response.raise_for_status()
-    raw_response = response.json()
-    MOLTIN_ACCESS_TOKEN = raw_response['access_token']
-    TOKEN_CREATED_AT = raw_response['expires']
-    return MOLTIN_ACCESS_TOKEN
+logger = logging.getLogger('moltin_helpers')
+_moltin_client = None
+_moltin_client_lock = threading.Lock()
+_opened_connections = threading.local()
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
 
 
-def download_product(moltin_access_token, name, description, price, slug):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
+def count_opened_connection():
+    _opened_connections.count = getattr(_opened_connections, 'count', 0) + 1
+
+
+def pop_opened_connections():
+    count = getattr(_opened_connections, 'count', 0)
+    _opened_connections.count = 0
+    return count
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+
+    def _new_conn(self):
+        count_opened_connection()
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+
+    def _new_conn(self):
+        count_opened_connection()
+        return super()._new_conn()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+class MoltinClient:
+
+    def __init__(self, base_url=MOLTIN_API_URL, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = CountingHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount(self.base_url, self.adapter)
+        self._auth_headers = {}
+        self._stats = defaultdict(lambda: {'requests': 0, 'new_connections': 0})
+        self._stats_lock = threading.Lock()
+
+    def get_auth_headers(self, moltin_access_token):
+        headers = self._auth_headers.get(moltin_access_token)
+        if headers is None:
+            headers = {'Authorization': f'Bearer {moltin_access_token}'}
+            self._auth_headers = {moltin_access_token: headers}
+        return headers
+
+    def request(self, method, endpoint, moltin_access_token, *path_args, **kwargs):
+        url = f'{self.base_url}{endpoint.format(*path_args)}'
+        if moltin_access_token:
+            kwargs['headers'] = self.get_auth_headers(moltin_access_token)
+        kwargs.setdefault('timeout', self.timeout)
+        pop_opened_connections()
+        with measure('upstream', service='moltin', call=f'{method} {endpoint}'):
+            response = self.session.request(method, url, **kwargs)
+            new_connections = pop_opened_connections()
+            with self._stats_lock:
+                endpoint_stats = self._stats[f'{method} {endpoint}']
+                endpoint_stats['requests'] += 1
+                endpoint_stats['new_connections'] += new_connections
+            response.raise_for_status()
+        return response
+
+    def get(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return self.request('GET', endpoint, moltin_access_token, *path_args, **kwargs)
+
+    def post(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return self.request('POST', endpoint, moltin_access_token, *path_args, **kwargs)
+
+    def delete(self, endpoint, moltin_access_token, *path_args, **kwargs):
+        return self.request('DELETE', endpoint, moltin_access_token, *path_args, **kwargs)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = {endpoint: dict(endpoint_stats) for endpoint, endpoint_stats in self._stats.items()}
+        for endpoint_stats in stats.values():
+            endpoint_stats['reused_connections'] = endpoint_stats['requests'] - endpoint_stats['new_connections']
+        return stats
+
+
+def get_moltin_client(base_url=None, pool_size=None, timeout=None):
+    global _moltin_client
+    with _moltin_client_lock:
+        if _moltin_client is None:
+            _moltin_client = MoltinClient(base_url or MOLTIN_API_URL, pool_size or DEFAULT_POOL_SIZE,
+                                          timeout or DEFAULT_TIMEOUT)
+            return _moltin_client
+    settings = {'base_url': base_url and base_url.rstrip('/'), 'pool_size': pool_size, 'timeout': timeout}
+    for name, value in settings.items():
+        if value is not None and value != getattr(_moltin_client, name):
+            logger.warning(f'Клиент Moltin уже создан, {name}={value!r} не применен '
+                           f'(используется {getattr(_moltin_client, name)!r})')
+    return _moltin_client
+
+
+def get_request_seconds(timeout):
+    if isinstance(timeout, (tuple, list)):
+        return sum(timeout)
+    return timeout
+
+
+class MoltinTokenManager:
+
+    def __init__(self, client_id, client_secret, db=None, refresh_margin=TOKEN_REFRESH_MARGIN,
+                 lock_timeout=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.db = db
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self.access_token, self.expires = None, 0
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._stats = {
+            'refreshes': 0,
+            'background_refreshes': 0,
+            'shared_token_hits': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+        }
+
+    @property
+    def shared_key(self):
+        return f'moltin_token_{self.client_id}'
+
+    def is_fresh(self, margin):
+        return bool(self.access_token) and self.expires - time.time() > margin
+
+    def get_token(self):
+        if self.is_fresh(self.refresh_margin):
+            return self.access_token
+        wait_started_at = time.monotonic()
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_seconds'] += time.monotonic() - wait_started_at
+            if not self.is_fresh(self.refresh_margin):
+                self._refresh(self.refresh_margin)
+            return self.access_token
+
+    def start_background_refresh(self, margin=TOKEN_BACKGROUND_REFRESH_MARGIN):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(target=self._run_background_refresh, args=(margin,), daemon=True)
+        self._refresh_thread.start()
+
+    def get_stats(self):
+        return dict(self._stats)
+
+    def _run_background_refresh(self, margin):
+        while True:
+            time.sleep(max(self.expires - time.time() - margin, 1))
+            if self.is_fresh(margin):
+                continue
+            try:
+                with self._lock:
+                    if not self.is_fresh(margin):
+                        self._refresh(margin)
+                        self._stats['background_refreshes'] += 1
+            except Exception:
+                logger.exception('Не удалось обновить токен Moltin')
+
+    def _refresh(self, margin):
+        if not self.db:
+            self._request_token()
+            return
+        if self._load_shared_token(margin):
+            return
+        lock_timeout = self.lock_timeout or get_request_seconds(get_moltin_client().timeout) + TOKEN_LOCK_MARGIN
+        shared_lock = self.db.lock(f'{self.shared_key}_lock', timeout=lock_timeout)
+        acquired = shared_lock.acquire(blocking_timeout=lock_timeout)
+        try:
+            if acquired and self._load_shared_token(margin):
+                return
+            self._request_token()
+            token_ttl = int(self.expires - time.time())
+            if token_ttl > 0:
+                shared_token = {'access_token': self.access_token, 'expires': self.expires}
+                self.db.set(self.shared_key, json.dumps(shared_token), ex=token_ttl)
+        finally:
+            if acquired:
+                try:
+                    shared_lock.release()
+                except LockNotOwnedError:
+                    logger.warning('Блокировка обновления токена Moltin истекла до завершения запроса')
+
+    def _load_shared_token(self, margin):
+        shared_token = self.db.get(self.shared_key)
+        if not shared_token:
+            return False
+        shared_token = json.loads(shared_token)
+        if shared_token['expires'] - time.time() <= margin:
+            return False
+        self.access_token, self.expires = shared_token['access_token'], shared_token['expires']
+        self._stats['shared_token_hits'] += 1
+        return True
+
+    def _request_token(self):
+        data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'client_credentials',
+        }
+        response = get_moltin_client().post('/oauth/access_token', None, data=data)
+        raw_response = response.json()
+        self.access_token, self.expires = raw_response['access_token'], raw_response['expires']
+        self._stats['refreshes'] += 1
+
+
+def get_token_manager(client_id, client_secret, db=None):
+    with _token_managers_lock:
+        token_manager = _token_managers.get(client_id)
+        if token_manager is None:
+            token_manager = MoltinTokenManager(client_id, client_secret, db)
+            _token_managers[client_id] = token_manager
+        elif db is not None and token_manager.db is None:
+            token_manager.db = db
+    return token_manager
+
+
+def get_moltin_access_token(client_id, client_secret):
+    return get_token_manager(client_id, client_secret).get_token()
+
+
+def is_transient_error(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def is_unsent_request_error(error):
+    """Ошибки, после которых запрос точно не был применен сервером и его можно отправить снова без дублей."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), ConnectTimeoutError)
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429
+    return False
+
+
+def call_with_retry(function, *args, attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, is_retryable=is_transient_error,
+                    **kwargs):
+    for attempt in range(attempts):
+        try:
+            return function(*args, **kwargs)
+        except requests.RequestException as error:
+            if attempt == attempts - 1 or not is_retryable(error):
+                raise
+            retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+            time.sleep(float(retry_after) if retry_after else backoff * 2 ** attempt)
+
+
+def get_prefetch_executor():
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    return _prefetch_executor
+
+
+def get_next_page_params(page):
+    links = page.get('links') or {}
+    next_link = links.get('next')
+    if not page.get('data') or not next_link or next_link in (links.get('current'), links.get('self')):
+        return None
+    return dict(parse_qsl(urlsplit(next_link).query))
+
+
+def get_page(endpoint, moltin_access_token, path_args, params):
+    return get_moltin_client().get(endpoint, moltin_access_token, *path_args, params=params).json()
+
+
+def iter_pages(endpoint, moltin_access_token, *path_args, params=None, page_size=PAGE_SIZE, prefetch=False):
+    page_params = {**(params or {}), 'page[limit]': page_size, 'page[offset]': 0}
+    page = get_page(endpoint, moltin_access_token, path_args, page_params)
+    while page is not None:
+        next_page_params = get_next_page_params(page)
+        next_page = None
+        if next_page_params is not None:
+            next_page_params = {**(params or {}), **next_page_params}
+            if prefetch:
+                next_page = get_prefetch_executor().submit(get_page, endpoint, moltin_access_token,
+                                                           path_args, next_page_params)
+        yield page
+        if next_page_params is None:
+            return
+        if next_page is not None:
+            page = next_page.result()
+        else:
+            page = get_page(endpoint, moltin_access_token, path_args, next_page_params)
+
+
+def iter_items(endpoint, moltin_access_token, *path_args, **kwargs):
+    for page in iter_pages(endpoint, moltin_access_token, *path_args, **kwargs):
+        yield from page['data']
+
+
+PRODUCTS_ENDPOINT = '/v2/products'
+PRODUCT_ENDPOINT = '/v2/products/{}'
+PRODUCT_MAIN_IMAGE_ENDPOINT = '/v2/products/{}/relationships/main-image'
+PRODUCT_CATEGORIES_ENDPOINT = '/v2/products/{}/relationships/categories'
+FILES_ENDPOINT = '/v2/files'
+FILE_ENDPOINT = '/v2/files/{}'
+FLOWS_ENDPOINT = '/v2/flows'
+FLOW_ENDPOINT = '/v2/flows/{}'
+FLOW_FIELDS_ENDPOINT = '/v2/flows/{}/fields'
+FIELDS_ENDPOINT = '/v2/fields'
+ENTRIES_ENDPOINT = '/v2/flows/{}/entries'
+ENTRY_ENDPOINT = '/v2/flows/{}/entries/{}'
+CART_ENDPOINT = '/v2/carts/{}'
+CART_ITEMS_ENDPOINT = '/v2/carts/{}/items'
+CART_ITEM_ENDPOINT = '/v2/carts/{}/items/{}'
+CUSTOMERS_ENDPOINT = '/v2/customers'
+CATEGORIES_ENDPOINT = '/v2/categories'
+CATEGORY_ENDPOINT = '/v2/categories/{}'
+
+
+def get_product_payload(name, description, price, slug):
+    return {
         'data': {
             'type': 'product',
             'name': name,
@@ -49,92 +381,25 @@ def download_product(moltin_access_token, name, description, price, slug):
             'commodity_type': 'physical',
         },
     }
-    response = requests.post('https://api.moltin.com/v2/products', headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']
 
 
-def download_image(moltin_access_token, image_url):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    files = {
+def get_image_files(image_url):
+    return {
         'file_location': (None, image_url),
     }
-    response = requests.post('https://api.moltin.com/v2/files', headers=headers, files=files)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def get_image_by_id(moltin_access_token, image_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/files/{image_id}', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def get_all_images(moltin_access_token):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get('https://api.moltin.com/v2/files', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def delete_image(moltin_access_token, image_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-
-    response = requests.delete(f'https://api.moltin.com/v2/files/{image_id}', headers=headers)
-    response.raise_for_status()
-
-
-def get_all_products(moltin_access_token):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get('https://api.moltin.com/v2/products', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def delete_product(moltin_access_token, product_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.delete(f'https://api.moltin.com/v2/products/{product_id}', headers=headers)
-    response.raise_for_status()
 
 
-def create_main_image_relationship(moltin_access_token, product_id, image_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
+def get_main_image_payload(image_id):
+    return {
         'data': {
             'type': 'main_image',
             'id': image_id,
         },
     }
-    response = requests.post(
-        f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
-        headers=headers,
-        json=payload,
-    )
-    response.raise_for_status()
 
 
-def create_flow(moltin_access_token, flow_name, slug, description):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
+def get_flow_payload(flow_name, slug, description):
+    return {
         'data': {
             'type': 'flow',
             'name': flow_name,
@@ -143,26 +408,10 @@ def create_flow(moltin_access_token, flow_name, slug, description):
             'enabled': True,
         },
     }
-    response = requests.post('https://api.moltin.com/v2/flows', headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']
 
 
-def get_flow(moltin_access_token, flow_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_id}', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def create_flow_field(moltin_access_token, flow_id, name, slug, field_type, description):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
+def get_flow_field_payload(flow_id, name, slug, field_type, description):
+    return {
         'data': {
             'type': 'field',
             'name': name,
@@ -181,16 +430,143 @@ def create_flow_field(moltin_access_token, flow_id, name, slug, field_type, desc
             },
         },
     }
-    response = requests.post('https://api.moltin.com/v2/fields', headers=headers, json=payload)
-    response.raise_for_status()
 
 
-def get_all_flow_fields(moltin_access_token, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
+def get_entry_payload(fields):
+    return {
+        'data': {
+            'type': 'entry',
+            **fields,
+        },
+    }
+
+
+def get_cart_item_payload(product_id, quantity):
+    return {
+        'data': {
+            'id': product_id,
+            'type': 'cart_item',
+            'quantity': int(quantity),
+        }
+    }
+
+
+def get_customer_payload(name, email):
+    return {
+        'data': {
+            'name': name,
+            'email': email,
+            'type': 'customer',
+        }
     }
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/fields', headers=headers)
-    response.raise_for_status()
+
+
+def get_category_payload(name, slug, status):
+    return {
+        'data': {
+            'type': 'category',
+            'name': name,
+            'slug': slug,
+            'status': status,
+        },
+    }
+
+
+def get_category_relationship_payload(category_id):
+    return {
+        'data': [
+            {
+                'type': 'category',
+                'id': category_id,
+            },
+        ],
+    }
+
+
+def get_category_products_params(category_id):
+    return {
+        'filter': f'eq(category.id,{category_id})'
+    }
+
+
+def get_slug_params(slug):
+    return {
+        'filter': f'eq(slug,{slug})'
+    }
+
+
+def download_product(moltin_access_token, name, description, price, slug):
+    payload = get_product_payload(name, description, price, slug)
+    response = get_moltin_client().post(PRODUCTS_ENDPOINT, moltin_access_token, json=payload)
+    return response.json()['data']
+
+
+def download_image(moltin_access_token, image_url):
+    response = get_moltin_client().post(FILES_ENDPOINT, moltin_access_token, files=get_image_files(image_url))
+    return response.json()['data']
+
+
+def get_image_by_id(moltin_access_token, image_id):
+    response = get_moltin_client().get(FILE_ENDPOINT, moltin_access_token, image_id)
+    return response.json()['data']
+
+
+def iter_images(moltin_access_token, **kwargs):
+    return iter_items(FILES_ENDPOINT, moltin_access_token, **kwargs)
+
+
+def get_all_images(moltin_access_token, **kwargs):
+    return list(iter_images(moltin_access_token, **kwargs))
+
+
+def delete_image(moltin_access_token, image_id):
+    get_moltin_client().delete(FILE_ENDPOINT, moltin_access_token, image_id)
+
+
+def iter_products(moltin_access_token, **kwargs):
+    return iter_items(PRODUCTS_ENDPOINT, moltin_access_token, **kwargs)
+
+
+def get_all_products(moltin_access_token, **kwargs):
+    return list(iter_products(moltin_access_token, **kwargs))
+
+
+def get_products_by_slug(moltin_access_token, slug):
+    response = get_moltin_client().get(PRODUCTS_ENDPOINT, moltin_access_token, params=get_slug_params(slug))
+    return response.json()['data']
+
+
+def delete_product(moltin_access_token, product_id):
+    get_moltin_client().delete(PRODUCT_ENDPOINT, moltin_access_token, product_id)
+
+
+def create_main_image_relationship(moltin_access_token, product_id, image_id):
+    get_moltin_client().post(PRODUCT_MAIN_IMAGE_ENDPOINT, moltin_access_token, product_id,
+                             json=get_main_image_payload(image_id))
+
+
+def create_flow(moltin_access_token, flow_name, slug, description):
+    payload = get_flow_payload(flow_name, slug, description)
+    response = get_moltin_client().post(FLOWS_ENDPOINT, moltin_access_token, json=payload)
+    return response.json()['data']
+
+
+def iter_flows(moltin_access_token, **kwargs):
+    return iter_items(FLOWS_ENDPOINT, moltin_access_token, **kwargs)
+
+
+def get_flow(moltin_access_token, flow_id):
+    response = get_moltin_client().get(FLOW_ENDPOINT, moltin_access_token, flow_id)
+    return response.json()['data']
+
+
+def create_flow_field(moltin_access_token, flow_id, name, slug, field_type, description):
+    payload = get_flow_field_payload(flow_id, name, slug, field_type, description)
+    get_moltin_client().post(FIELDS_ENDPOINT, moltin_access_token, json=payload)
+
+
+def get_all_flow_fields(moltin_access_token, flow_slug):
+    response = get_moltin_client().get(FLOW_FIELDS_ENDPOINT, moltin_access_token, flow_slug)
     return response.json()['data']
 
 
@@ -200,227 +576,115 @@ def create_pizzeria(moltin_access_token: str, flow_slug: str,
                     longitude_field_slug: str, longitude: float,
                     latitude_field_slug: str, latitude: float,
                     courier_id_slug: str, courier_id: str):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'data': {
-            'type': 'entry',
-            alias_field_slug: alias,
-            address_field_slug: address,
-            longitude_field_slug: longitude,
-            latitude_field_slug: latitude,
-            courier_id_slug: courier_id,
-        },
-    }
-    response = requests.post(f'https://api.moltin.com/v2/flows/{flow_slug}/entries', headers=headers, json=payload)
-    response.raise_for_status()
+    payload = get_entry_payload({
+        alias_field_slug: alias,
+        address_field_slug: address,
+        longitude_field_slug: longitude,
+        latitude_field_slug: latitude,
+        courier_id_slug: courier_id,
+    })
+    response = get_moltin_client().post(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, json=payload)
     return response.json()
 
 
 def create_customer_address(moltin_access_token: str, flow_slug: str,
                             longitude_field_slug: str, longitude: float,
                             latitude_field_slug: str, latitude: float):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'data': {
-            'type': 'entry',
-            longitude_field_slug: longitude,
-            latitude_field_slug: latitude,
-        },
-    }
-    response = requests.post(f'https://api.moltin.com/v2/flows/{flow_slug}/entries', headers=headers, json=payload)
-    response.raise_for_status()
+    payload = get_entry_payload({
+        longitude_field_slug: longitude,
+        latitude_field_slug: latitude,
+    })
+    response = get_moltin_client().post(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, json=payload)
     return response.json()
 
 
 def delete_entry(moltin_access_token, flow_slug, entry_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
+    get_moltin_client().delete(ENTRY_ENDPOINT, moltin_access_token, flow_slug, entry_id)
 
-    response = requests.delete(f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}', headers=headers)
-    response.raise_for_status()
 
+def iter_entries(moltin_access_token, flow_slug, **kwargs):
+    return iter_items(ENTRIES_ENDPOINT, moltin_access_token, flow_slug, **kwargs)
 
-def get_all_entries(moltin_access_token, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/entries', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+
+def get_all_entries(moltin_access_token, flow_slug, **kwargs):
+    return list(iter_entries(moltin_access_token, flow_slug, **kwargs))
 
 
 def create_user_cart(moltin_access_token, cart_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/carts/{cart_id}', headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().get(CART_ENDPOINT, moltin_access_token, cart_id)
     return response.json()
 
 
 def add_product_to_cart(moltin_access_token, product_id, cart_id, quantity=1):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'data': {
-            'id': product_id,
-            'type': 'cart_item',
-            'quantity': int(quantity),
-        }
-    }
-    response = requests.post(url=f'https://api.moltin.com/v2/carts/{cart_id}/items', headers=headers, json=payload)
-    response.raise_for_status()
+    payload = get_cart_item_payload(product_id, quantity)
+    response = get_moltin_client().post(CART_ITEMS_ENDPOINT, moltin_access_token, cart_id, json=payload)
     return response.json()
 
 
 def get_cart_items(moltin_access_token, cart_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().get(CART_ITEMS_ENDPOINT, moltin_access_token, cart_id)
     return response.json()['data']
 
 
 def get_product_by_id(moltin_access_token, product_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/products/{product_id}', headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().get(PRODUCT_ENDPOINT, moltin_access_token, product_id)
     return response.json()['data']
 
 
 def delete_product_from_cart(moltin_access_token, cart_id, product_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.delete(f'https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}', headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().delete(CART_ITEM_ENDPOINT, moltin_access_token, cart_id, product_id)
+    return response.json() if response.content else None
 
 
 def create_customer(moltin_access_token, name, email):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'data': {
-            'name': name,
-            'email': email,
-            'type': 'customer',
-        }
-    }
-    response = requests.post('https://api.moltin.com/v2/customers', headers=headers, json=payload)
-    response.raise_for_status()
+    payload = get_customer_payload(name, email)
+    response = get_moltin_client().post(CUSTOMERS_ENDPOINT, moltin_access_token, json=payload)
     return response.json()
 
 
 def get_entry(moltin_access_token, flow_slug, entry_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}', headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().get(ENTRY_ENDPOINT, moltin_access_token, flow_slug, entry_id)
     return response.json()['data']
 
 
 def create_category(moltin_access_token, name, slug, status='live'):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-
-    payload = {
-        'data': {
-            'type': 'category',
-            'name': name,
-            'slug': slug,
-            'status': status,
-        },
-    }
-
-    response = requests.post('https://api.moltin.com/v2/categories', headers=headers, json=payload)
-    response.raise_for_status()
+    payload = get_category_payload(name, slug, status)
+    response = get_moltin_client().post(CATEGORIES_ENDPOINT, moltin_access_token, json=payload)
     return response.json()['data']
 
 
 def add_category_product(moltin_access_token, category_id, product_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'data': [
-            {
-                'type': 'category',
-                'id': category_id,
-            },
-        ],
-    }
-    response = requests.post(
-        f'https://api.moltin.com/v2/products/{product_id}/relationships/categories',
-        headers=headers,
-        json=payload,
-    )
-    response.raise_for_status()
+    get_moltin_client().post(PRODUCT_CATEGORIES_ENDPOINT, moltin_access_token, product_id,
+                             json=get_category_relationship_payload(category_id))
 
 
 def get_category_by_id(moltin_access_token, category_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get(f'https://api.moltin.com/v2/categories/{category_id}', headers=headers)
-    response.raise_for_status()
+    response = get_moltin_client().get(CATEGORY_ENDPOINT, moltin_access_token, category_id)
     return response.json()['data']
 
 
-def get_products_by_category_id(moltin_access_token, category_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    params = {
-        'filter': f'eq(category.id,{category_id})'
-    }
-    response = requests.get('https://api.moltin.com/v2/products', params=params, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+def iter_products_by_category_id(moltin_access_token, category_id, **kwargs):
+    params = get_category_products_params(category_id)
+    return iter_items(PRODUCTS_ENDPOINT, moltin_access_token, params=params, **kwargs)
 
 
-def get_all_categories(moltin_access_token):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.get('https://api.moltin.com/v2/categories', headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+def get_products_by_category_id(moltin_access_token, category_id, **kwargs):
+    return list(iter_products_by_category_id(moltin_access_token, category_id, **kwargs))
+
+
+def iter_categories(moltin_access_token, **kwargs):
+    return iter_items(CATEGORIES_ENDPOINT, moltin_access_token, **kwargs)
+
+
+def get_all_categories(moltin_access_token, **kwargs):
+    return list(iter_categories(moltin_access_token, **kwargs))
 
 
 def get_category_by_slug(moltin_access_token, category_slug):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    params = {
-        'filter': f'eq(slug,{category_slug})'
-    }
-    response = requests.get('https://api.moltin.com/v2/categories', params=params, headers=headers)
-    response.raise_for_status()
+    params = get_slug_params(category_slug)
+    response = get_moltin_client().get(CATEGORIES_ENDPOINT, moltin_access_token, params=params)
     return response.json()['data']
 
 
 def delete_category(moltin_access_token, category_id):
-    headers = {
-        'Authorization': f'Bearer {moltin_access_token}',
-    }
-    response = requests.delete(f'https://api.moltin.com/v2/categories/{category_id}', headers=headers)
-    response.raise_for_status()
+    get_moltin_client().delete(CATEGORY_ENDPOINT, moltin_access_token, category_id)
@@ -0,0 +1,41 @@
+from telegram.error import BadRequest
+
+from image_helpers import get_image_href
+
+TELEGRAM_FILE_ID_KEY = 'telegram_file_id_{}_{}'
+
+
+def get_main_image_id(product):
+    relationships = product.get('relationships') or {}
+    main_image = relationships.get('main_image') or {}
+    return (main_image.get('data') or {}).get('id')
+
+
+def get_photo_file_id(db, product_id, image_id):
+    return db.get(TELEGRAM_FILE_ID_KEY.format(product_id, image_id))
+
+
+def send_product_photo(bot, db, moltin_access_token, chat_id, product_id, image_id, **kwargs):
+    file_id_key = TELEGRAM_FILE_ID_KEY.format(product_id, image_id)
+    file_id = get_photo_file_id(db, product_id, image_id)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest:
+            db.delete(file_id_key)
+    image_link = get_image_href(db, moltin_access_token, image_id)
+    message = bot.send_photo(chat_id=chat_id, photo=image_link, **kwargs)
+    db.set(file_id_key, message.photo[-1].file_id)
+    return message
+
+
+def warm_up_product_photos(bot, db, moltin_access_token, service_chat_id, products):
+    uploaded_photos = 0
+    for product in products:
+        image_id = get_main_image_id(product)
+        if not image_id or get_photo_file_id(db, product.get('id'), image_id):
+            continue
+        message = send_product_photo(bot, db, moltin_access_token, service_chat_id, product.get('id'), image_id)
+        bot.delete_message(chat_id=service_chat_id, message_id=message.message_id)
+        uploaded_photos += 1
+    return uploaded_photos
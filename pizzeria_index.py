@@ -0,0 +1,135 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+from geopy import distance
+
+from moltin_helpers import get_all_entries, get_moltin_access_token
+
+EARTH_RADIUS_KM = 6371.0088
+REFRESH_INTERVAL = 5 * 60
+
+logger = logging.getLogger('pizzeria_index')
+_place_indexes = {}
+_place_indexes_lock = threading.Lock()
+
+
+def get_unit_vector(latitude, longitude):
+    latitude, longitude = math.radians(float(latitude)), math.radians(float(longitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def get_chord_length(first_vector, second_vector):
+    return math.sqrt(sum((first - second) ** 2 for first, second in zip(first_vector, second_vector)))
+
+
+def convert_chord_to_km(chord_length):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord_length / 2, 1))
+
+
+def build_kd_tree(points, depth=0):
+    if not points:
+        return None
+    axis = depth % 3
+    points = sorted(points, key=lambda point: point[0][axis])
+    median = len(points) // 2
+    vector, place_number = points[median]
+    return (
+        vector,
+        place_number,
+        axis,
+        build_kd_tree(points[:median], depth + 1),
+        build_kd_tree(points[median + 1:], depth + 1),
+    )
+
+
+def search_kd_tree(node, target, k, nearest):
+    if node is None:
+        return
+    vector, place_number, axis, left, right = node
+    chord_length = get_chord_length(vector, target)
+    if len(nearest) < k:
+        heapq.heappush(nearest, (-chord_length, place_number))
+    elif chord_length < -nearest[0][0]:
+        heapq.heapreplace(nearest, (-chord_length, place_number))
+    axis_difference = target[axis] - vector[axis]
+    near_branch, far_branch = (left, right) if axis_difference < 0 else (right, left)
+    search_kd_tree(near_branch, target, k, nearest)
+    if len(nearest) < k or abs(axis_difference) < -nearest[0][0]:
+        search_kd_tree(far_branch, target, k, nearest)
+
+
+class PlaceIndex:
+
+    def __init__(self, moltin_client_id, moltin_client_secret, flow_slug, refresh_interval=REFRESH_INTERVAL):
+        self.moltin_client_id = moltin_client_id
+        self.moltin_client_secret = moltin_client_secret
+        self.flow_slug = flow_slug
+        self.refresh_interval = refresh_interval
+        self.snapshot, self.loaded_at = ([], None), None
+        self.listeners = []
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+
+    def load(self):
+        moltin_access_token = get_moltin_access_token(self.moltin_client_id, self.moltin_client_secret)
+        places = get_all_entries(moltin_access_token, self.flow_slug, prefetch=True)
+        points = [
+            (get_unit_vector(place['latitude'], place['longitude']), place_number)
+            for place_number, place in enumerate(places)
+        ]
+        self.snapshot = (places, build_kd_tree(points))
+        self.loaded_at = time.monotonic()
+        for listener in self.listeners:
+            listener(places)
+
+    @property
+    def places(self):
+        return self.snapshot[0]
+
+    def start_background_refresh(self):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(target=self._run_background_refresh, daemon=True)
+        self._refresh_thread.start()
+
+    def ensure_loaded(self):
+        if self.loaded_at is None:
+            with self._load_lock:
+                if self.loaded_at is None:
+                    self.load()
+
+    def get_nearest(self, coordinates, k=1):
+        self.ensure_loaded()
+        places, tree = self.snapshot
+        nearest = []
+        search_kd_tree(tree, get_unit_vector(*coordinates), k, nearest)
+        nearest_places = []
+        for _, place_number in sorted(nearest, reverse=True):
+            place = places[place_number]
+            place_distance = distance.distance((place['latitude'], place['longitude']), coordinates).km
+            nearest_places.append((place, place_distance))
+        return sorted(nearest_places, key=lambda nearest_place: nearest_place[1])
+
+    def _run_background_refresh(self):
+        while True:
+            try:
+                self.load()
+            except Exception:
+                logger.exception(f'Не удалось обновить индекс {self.flow_slug}')
+            time.sleep(self.refresh_interval)
+
+
+def get_place_index(moltin_client_id, moltin_client_secret, flow_slug):
+    with _place_indexes_lock:
+        place_index = _place_indexes.get(flow_slug)
+        if place_index is None:
+            place_index = PlaceIndex(moltin_client_id, moltin_client_secret, flow_slug)
+            _place_indexes[flow_slug] = place_index
+    return place_index
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+import redis
+from redis.client import Pipeline
+
+from metrics_helpers import measure
+
+MAX_CONNECTIONS = 32
+HEALTH_CHECK_INTERVAL = 30
+SOCKET_TIMEOUT = 5
+STATE_CACHE_SIZE = 4096
+BLOCKING_COMMANDS = {'BLPOP', 'BRPOP', 'BRPOPLPUSH', 'BLMOVE', 'BZPOPMIN', 'BZPOPMAX'}
+
+_database = None
+_database_lock = threading.Lock()
+
+
+class MeasuredPipeline(Pipeline):
+
+    def execute(self, raise_on_error=True):
+        with measure('upstream', service='redis', call='PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class MeasuredRedis(redis.Redis):
+
+    def execute_command(self, *args, **options):
+        if args[0] in BLOCKING_COMMANDS:
+            return super().execute_command(*args, **options)
+        with measure('upstream', service='redis', call=args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeasuredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def get_database_connection(host=None, port=None, password=None):
+    global _database
+    with _database_lock:
+        if _database is None:
+            connection_pool = redis.BlockingConnectionPool(
+                host=host or os.getenv('DATABASE_HOST'),
+                port=int(port or os.getenv('DATABASE_PORT')),
+                password=password or os.getenv('DATABASE_PASSWORD'),
+                max_connections=MAX_CONNECTIONS,
+                health_check_interval=HEALTH_CHECK_INTERVAL,
+                socket_timeout=SOCKET_TIMEOUT,
+                socket_connect_timeout=SOCKET_TIMEOUT,
+                socket_keepalive=True,
+                retry_on_timeout=True,
+                decode_responses=True,
+            )
+            _database = MeasuredRedis(connection_pool=connection_pool)
+    return _database
+
+
+class StateStore:
+
+    def __init__(self, db, key_template, default_state=None, cache_size=STATE_CACHE_SIZE):
+        self.db = db
+        self.key_template = key_template
+        self.default_state = default_state
+        self.cache_size = cache_size
+        self._states = OrderedDict()
+        self._states_lock = threading.Lock()
+
+    def get_state(self, chat_id):
+        with self._states_lock:
+            if chat_id in self._states:
+                self._states.move_to_end(chat_id)
+                return self._states[chat_id]
+        state = self.db.get(self.key_template.format(chat_id)) or self.default_state
+        self._remember_state(chat_id, state)
+        return state
+
+    def set_state(self, chat_id, state):
+        self.db.set(self.key_template.format(chat_id), state)
+        self._remember_state(chat_id, state)
+
+    def get_states(self, chat_ids):
+        states = self.db.mget([self.key_template.format(chat_id) for chat_id in chat_ids])
+        return {chat_id: state or self.default_state for chat_id, state in zip(chat_ids, states)}
+
+    def forget(self, chat_id):
+        with self._states_lock:
+            self._states.pop(chat_id, None)
+
+    def _remember_state(self, chat_id, state):
+        if not self.cache_size:
+            return
+        with self._states_lock:
+            self._states[chat_id] = state
+            self._states.move_to_end(chat_id)
+            while len(self._states) > self.cache_size:
+                self._states.popitem(last=False)
@@ -1,32 +1,47 @@
 import logging
-import os
 
-import redis
 import telegram
 from environs import Env
-from geopy import distance
 from requests.exceptions import HTTPError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (CallbackQueryHandler, CommandHandler, Filters,
                           MessageHandler, PreCheckoutQueryHandler, Updater)
+from telegram.utils.request import Request
 
+from cart_helpers import (add_to_cart, get_cached_cart_items, reconcile_cart,
+                          remove_from_cart)
+from catalog_helpers import get_products
+from delivery_zones import get_delivery_zones
 from format_message import (create_cart_description,
                             create_product_description, get_total_price)
-from geo_helpers import fetch_coordinates, get_nearest_place
+from geo_helpers import fetch_coordinates
 from log_helpers import TelegramLogsHandler
-from moltin_helpers import (add_product_to_cart, create_customer,
-                            create_customer_address, delete_product_from_cart,
-                            get_all_products, get_cart_items, get_entry,
-                            get_image_by_id, get_moltin_access_token,
-                            get_product_by_id)
-
-_database = None
+from metrics_helpers import measure, start_metrics_server
+from moltin_helpers import (create_customer, create_customer_address,
+                            get_entry, get_moltin_access_token,
+                            get_moltin_client, get_product_by_id,
+                            get_token_manager)
+from photo_helpers import get_main_image_id, send_product_photo
+from pizzeria_index import get_place_index
+from state_store import STATE_CACHE_SIZE, StateStore, get_database_connection
+
+UPDATER_WORKERS = 4
+DELIVERY_PRICES = ('бесплатно', 'за 100 рублей', 'за 300 рублей')
+
+_state_store = None
 logger = logging.getLogger('tg_bot')
 
 
+class MeasuredRequest(Request):
+
+    def post(self, url, data, timeout=None):
+        with measure('upstream', service='telegram', call=url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
 def get_menu_keyboard(query):
     moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
-    products = get_all_products(moltin_access_token)
+    products = get_products(get_database_connection(), moltin_access_token)
     products_per_page = 8
     page = 0
     if query:
@@ -73,7 +88,7 @@ def handle_menu(bot, update):
         bot.send_message(text='Меню пицц:', chat_id=query.message.chat_id, reply_markup=reply_markup)
         return 'HANDLE_MENU'
     if query.data == 'Корзина':
-        cart_items = get_cart_items(moltin_access_token, query.message.chat_id)
+        cart_items = get_cached_cart_items(get_database_connection(), moltin_access_token, query.message.chat_id)
         if cart_items:
             message = create_cart_description(cart_items)
             keyboard = get_cart_keyboard(cart_items)
@@ -92,11 +107,10 @@ def handle_menu(bot, update):
         [InlineKeyboardButton('Назад', callback_data='Назад')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    if product.get('relationships'):
-        image = get_image_by_id(moltin_access_token,
-                                product.get('relationships').get('main_image').get('data').get('id'))
-        image_link = image.get('link').get('href')
-        bot.send_photo(chat_id=query.message.chat_id, caption=message, photo=image_link, reply_markup=reply_markup)
+    image_id = get_main_image_id(product)
+    if image_id:
+        send_product_photo(bot, get_database_connection(), moltin_access_token, query.message.chat_id,
+                           product_id, image_id, caption=message, reply_markup=reply_markup)
         bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
         return 'HANDLE_DESCRIPTION'
     bot.send_message(text=message, chat_id=query.message.chat_id, reply_markup=reply_markup)
@@ -114,7 +128,7 @@ def handle_description(bot, update):
         bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
         return 'HANDLE_MENU'
     if query.data == 'Корзина':
-        cart_items = get_cart_items(moltin_access_token, query.message.chat_id)
+        cart_items = get_cached_cart_items(get_database_connection(), moltin_access_token, query.message.chat_id)
         if cart_items:
             message = create_cart_description(cart_items)
             keyboard = get_cart_keyboard(cart_items)
@@ -125,7 +139,7 @@ def handle_description(bot, update):
         bot.send_message(text=message, chat_id=query.message.chat_id, reply_markup=reply_markup)
         return 'HANDLE_CART'
     product_id = query.data
-    add_product_to_cart(moltin_access_token, product_id, query.message.chat_id)
+    add_to_cart(get_database_connection(), moltin_access_token, product_id, query.message.chat_id)
     update.callback_query.answer("Товар добавлен в корзину")
     return 'HANDLE_DESCRIPTION'
 
@@ -143,8 +157,7 @@ def handle_cart(bot, update):
         message = 'Пожалуйста введите Вашу электронную почту:'
         bot.send_message(text=message, chat_id=query.message.chat_id)
         return 'HANDLE_WAITING_EMAIL'
-    delete_product_from_cart(moltin_access_token, query.message.chat_id, query.data)
-    cart_items = get_cart_items(moltin_access_token, query.message.chat_id)
+    cart_items = remove_from_cart(get_database_connection(), moltin_access_token, query.message.chat_id, query.data)
     if cart_items:
         message = create_cart_description(cart_items)
         keyboard = get_cart_keyboard(cart_items)
@@ -176,7 +189,7 @@ def handle_waiting_email(bot, update):
 def handle_waiting_address(bot, update):
     address = update.message.text
     if address:
-        customer_coordinates = fetch_coordinates(yandex_api_key, address)
+        customer_coordinates = fetch_coordinates(yandex_api_key, address, get_database_connection())
         if not customer_coordinates:
             bot.send_message(text='Некорректный адрес, повторите попытку:', chat_id=update.message.chat_id)
             return 'HANDLE_WAITING_ADDRESS'
@@ -186,19 +199,14 @@ def handle_waiting_address(bot, update):
         else:
             message = update.message
         customer_coordinates = (message.location.latitude, message.location.longitude)
-    nearest_pizzeria = get_nearest_place(customer_coordinates, moltin_client_id, moltin_client_secret, 'pizzeria')
-    raw_pizzeria_distance = distance.distance((nearest_pizzeria.get('latitude'), nearest_pizzeria.get('longitude')),
-                                              customer_coordinates)
-    pizzeria_distance = round(float((str(raw_pizzeria_distance)).split()[0]), 1)
+    delivery_zones = get_delivery_zones(moltin_client_id, moltin_client_secret, 'pizzeria', get_database_connection())
+    nearest_pizzeria, pizzeria_distance, delivery_tier = delivery_zones.get_delivery(customer_coordinates)
+    pizzeria_distance = round(pizzeria_distance, 1)
     nearest_pizzeria_address = nearest_pizzeria["address"]
     pizzeria_id = nearest_pizzeria['id']
     courier_chat_id = nearest_pizzeria['courier_id']
-    if pizzeria_distance <= 0.5:
-        delivery_price = 'бесплатно'
-    elif pizzeria_distance <= 5:
-        delivery_price = 'за 100 рублей'
-    elif pizzeria_distance <= 20:
-        delivery_price = 'за 300 рублей'
+    if delivery_tier is not None:
+        delivery_price = DELIVERY_PRICES[delivery_tier]
     else:
         message = f'К сожалению, мы не можем доставить на этот адрес, он очень далеко от нас.\n' \
                   f'Но Вы можете, забрать пиццу из нашей пиццерии. ' \
@@ -247,7 +255,7 @@ def handle_waiting_delivery(bot, update):
         return 'HANDLE_WAITING_DELIVERY'
     if command == 'Доставка':
         courier_chat_id, customer_chat_id, customer_latitude, customer_longitude = about_delivery.split(',')
-        cart_items = get_cart_items(moltin_access_token, customer_chat_id)
+        cart_items = reconcile_cart(get_database_connection(), moltin_access_token, customer_chat_id)
         message = create_cart_description(cart_items)
         create_customer_address(moltin_access_token, 'customer_address',
                                 'latitude', float(customer_latitude),
@@ -288,7 +296,7 @@ def precheckout_callback(bot, update):
 
 
 def handle_users_reply(bot, update):
-    db = get_database_connection()
+    state_store = get_state_store()
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -300,7 +308,7 @@ def handle_users_reply(bot, update):
     if user_reply == '/start':
         user_state = 'START'
     else:
-        user_state = db.get(f'telegram_id_{chat_id}').decode('utf-8')
+        user_state = state_store.get_state(chat_id)
 
     states_functions = {
         'START': start,
@@ -314,52 +322,71 @@ def handle_users_reply(bot, update):
     }
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(bot, update)
-        db.set(f'telegram_id_{chat_id}', next_state)
+        with measure('state_handler', bot='telegram', state=user_state):
+            next_state = state_handler(bot, update)
+        state_store.set_state(chat_id, next_state)
     except Exception:
         logger.exception('Произошла ошибка:')
 
 
-def get_database_connection():
-    global _database
-    if _database is None:
-        database_password = os.getenv('DATABASE_PASSWORD')
-        database_host = os.getenv('DATABASE_HOST')
-        database_port = os.getenv('DATABASE_PORT')
-        _database = redis.Redis(host=database_host, port=int(database_port), password=database_password)
-    return _database
+def get_state_store(cache_size=STATE_CACHE_SIZE):
+    global _state_store
+    if _state_store is None:
+        _state_store = StateStore(get_database_connection(), 'telegram_id_{}', default_state='START',
+                                  cache_size=cache_size)
+    return _state_store
+
+
+def read_settings(env):
+    global moltin_client_id, moltin_client_secret, yandex_api_key, provider_token
+    moltin_client_id = env('MOLTIN_CLIENT_ID')
+    moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
+    yandex_api_key = env('YANDEX_API_KEY')
+    provider_token = env('PROVIDER_TOKEN')
+
+
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
+    dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
+    dispatcher.add_handler(CommandHandler('start', handle_users_reply))
+    dispatcher.add_handler(CallbackQueryHandler(handle_menu))
+    handle_location = MessageHandler(Filters.location, handle_waiting_address)
+    dispatcher.add_handler(handle_location)
+    dispatcher.add_handler(
+        MessageHandler(Filters.successful_payment, successful_payment_callback, pass_job_queue=True))
+    dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     env = Env()
     env.read_env()
+    read_settings(env)
     tg_token = env('TG_TOKEN')
-    moltin_client_id = env('MOLTIN_CLIENT_ID')
-    moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
     tg_chat_id = env('TG_CHAT_ID')
-    yandex_api_key = env('YANDEX_API_KEY')
-    provider_token = env('PROVIDER_TOKEN')
+    moltin_timeout = env.float('MOLTIN_TIMEOUT', 15)
+    metrics_port = env.int('METRICS_PORT', None)
     tg_bot = telegram.Bot(token=tg_token)
     logger.setLevel(logging.INFO)
     logger.addHandler(TelegramLogsHandler(tg_bot, tg_chat_id))
     logger.info('Бот для логов запущен')
 
-    updater = Updater(tg_token)
+    updater = Updater(bot=telegram.Bot(token=tg_token, request=MeasuredRequest(con_pool_size=UPDATER_WORKERS + 4)),
+                      workers=UPDATER_WORKERS)
     dispatcher = updater.dispatcher
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    get_moltin_client(pool_size=dispatcher.workers, timeout=moltin_timeout)
+    token_manager = get_token_manager(moltin_client_id, moltin_client_secret, get_database_connection())
+    token_manager.start_background_refresh()
+    get_delivery_zones(moltin_client_id, moltin_client_secret, 'pizzeria', get_database_connection(),
+                       env('DELIVERY_ZONES_PATH', None))
+    get_place_index(moltin_client_id, moltin_client_secret, 'pizzeria').start_background_refresh()
 
     while True:
 
         try:
-            dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-            dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
-            dispatcher.add_handler(CommandHandler('start', handle_users_reply))
-            updater.dispatcher.add_handler(CallbackQueryHandler(handle_menu))
-            handle_location = MessageHandler(Filters.location, handle_waiting_address)
-            dispatcher.add_handler(handle_location)
-            dispatcher.add_handler(
-                MessageHandler(Filters.successful_payment, successful_payment_callback, pass_job_queue=True))
-            dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+            add_handlers(dispatcher)
             updater.start_polling()
             logger.info('TG бот запущен')
             updater.idle()
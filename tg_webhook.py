@@ -0,0 +1,143 @@
+import logging
+import threading
+from queue import Queue
+
+import telegram
+from environs import Env
+from flask import Flask, Response, jsonify, request
+from telegram.ext import Dispatcher, JobQueue
+
+import tg_bot
+from cart_helpers import get_cart_stats
+from delivery_zones import get_delivery_zones
+from event_queue import EventWorkerPool, enqueue_events
+from log_helpers import TelegramLogsHandler
+from metrics_helpers import CONTENT_TYPE, render_metrics, start_metrics_sync
+from moltin_helpers import get_moltin_client, get_token_manager
+from pizzeria_index import get_place_index
+from state_store import get_database_connection
+
+EVENTS_QUEUE_NAME = 'telegram'
+
+app = Flask(__name__)
+_settings = None
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_event_workers = None
+logger = logging.getLogger('tg_webhook')
+
+
+@app.route('/<url_token>', methods=['POST'])
+def webhook(url_token):
+    """
+    Вебхук, на который Telegram присылает апдейты. Апдейты складываются в очередь Redis по chat_id и
+    обрабатываются в фоне любым процессом, апдейты одного чата обрабатываются по порядку.
+    """
+    if url_token != get_settings()['tg_token']:
+        return 'Not found', 404
+    update = request.get_json(silent=True)
+    if not update or 'update_id' not in update:
+        return 'ok', 200
+    enqueue_events(get_database_connection(), EVENTS_QUEUE_NAME, [(get_update_chat_id(update), update)])
+    return 'ok', 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/queue', methods=['GET'])
+def queue_stats():
+    stats = get_event_workers().get_stats()
+    stats['carts'] = get_cart_stats()
+    return jsonify(stats), 200
+
+
+def get_update_chat_id(update):
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if value.get('from'):
+            return value['from']['id']
+    return update['update_id']
+
+
+def handle_update(update):
+    dispatcher = get_dispatcher()
+    dispatcher.process_update(telegram.Update.de_json(update, dispatcher.bot))
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            return _dispatcher
+        settings = get_settings()
+        bot = telegram.Bot(
+            token=settings['tg_token'],
+            request=tg_bot.MeasuredRequest(con_pool_size=settings['event_workers'] + 4),
+        )
+        job_queue = JobQueue(bot)
+        dispatcher = Dispatcher(bot, Queue(), workers=0, job_queue=job_queue)
+        tg_bot.add_handlers(dispatcher)
+        # Вызывается из потока обработчика очереди, поэтому поток JobQueue тоже будет фоновым
+        # и не задержит остановку процесса gunicorn.
+        job_queue.start()
+        _dispatcher = dispatcher
+        return _dispatcher
+
+
+def get_event_workers():
+    global _event_workers
+    if _event_workers is None:
+        settings = get_settings()
+        get_moltin_client(pool_size=settings['event_workers'], timeout=settings['moltin_timeout'])
+        tg_bot.logger.setLevel(logging.INFO)
+        tg_bot.logger.addHandler(TelegramLogsHandler(telegram.Bot(token=settings['tg_token']), settings['tg_chat_id']))
+        db = get_database_connection()
+        start_metrics_sync(db, EVENTS_QUEUE_NAME)
+        tg_bot.get_state_store(cache_size=0)
+        get_token_manager(settings['moltin_client_id'], settings['moltin_client_secret'], db).start_background_refresh()
+        get_delivery_zones(settings['moltin_client_id'], settings['moltin_client_secret'], 'pizzeria', db,
+                           settings['delivery_zones_path'])
+        get_place_index(settings['moltin_client_id'], settings['moltin_client_secret'],
+                        'pizzeria').start_background_refresh()
+        _event_workers = EventWorkerPool(db, EVENTS_QUEUE_NAME, handle_update, workers=settings['event_workers'])
+    return _event_workers
+
+
+def create_app():
+    get_event_workers().start()
+    return app
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        env = Env()
+        env.read_env()
+        tg_bot.read_settings(env)
+        _settings = {
+            'tg_token': env('TG_TOKEN'),
+            'tg_chat_id': env('TG_CHAT_ID'),
+            'moltin_client_id': env('MOLTIN_CLIENT_ID'),
+            'moltin_client_secret': env('MOLTIN_CLIENT_SECRET'),
+            'moltin_timeout': env.float('MOLTIN_TIMEOUT', 15),
+            'event_workers': env.int('TG_EVENT_WORKERS', 4),
+            'delivery_zones_path': env('DELIVERY_ZONES_PATH', None),
+        }
+    return _settings
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    env = Env()
+    env.read_env()
+    settings = get_settings()
+    webhook_url = f"{env('TG_WEBHOOK_URL').rstrip('/')}/{settings['tg_token']}"
+    telegram.Bot(token=settings['tg_token']).set_webhook(url=webhook_url)
+    logger.info('Вебхук TG бота зарегистрирован')
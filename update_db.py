@@ -1,71 +1,106 @@
-import json
-import os
-from pprint import pprint
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import redis
 from environs import Env
 
-from moltin_helpers import (get_all_categories, get_category_by_slug,
-                            get_image_by_id, get_moltin_access_token,
+import async_moltin_helpers
+from catalog_helpers import save_categories, save_products
+from image_helpers import get_image_href, warm_up_image_cache
+from moltin_helpers import (call_with_retry, get_all_categories,
+                            get_all_products, get_category_by_slug,
+                            get_moltin_access_token,
                             get_products_by_category_id)
+from state_store import get_database_connection
 
-_database = None
+MAX_WORKERS = 8
 
 
-def get_database_connection():
-    global _database
-    if _database is None:
-        database_password = os.getenv('DATABASE_PASSWORD')
-        database_host = os.getenv('DATABASE_HOST')
-        database_port = os.getenv('DATABASE_PORT')
-        _database = redis.Redis(host=database_host, port=int(database_port),
-                                password=database_password, decode_responses=True)
-    return _database
+@contextmanager
+def measure_stage(stage_timings, stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timings[stage] = stage_timings.get(stage, 0) + time.perf_counter() - started_at
 
 
-def get_menu(front_page_category_slug='main'):
-    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
-    front_page_category = get_category_by_slug(moltin_access_token, front_page_category_slug)[0]
-    front_page_products = get_products_by_category_id(moltin_access_token,
-                                                      front_page_category.get('id'))
-    for product in front_page_products:
-        image = get_image_by_id(moltin_access_token,
-                                product.get('relationships').get('main_image').get('data').get('id'))
-        product['image_link'] = image.get('link').get('href')
-    front_page_category['products'] = front_page_products
-    return front_page_category
+def get_image_link(db, moltin_access_token, product, image_hrefs):
+    image_id = product.get('relationships').get('main_image').get('data').get('id')
+    return image_hrefs.get(image_id) or call_with_retry(get_image_href, db, moltin_access_token, image_id)
 
 
-def get_categories_with_products():
-    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
-    categories = get_all_categories(moltin_access_token)
-    for category in categories:
-        products = get_products_by_category_id(moltin_access_token, category.get('id'))
-        for product in products:
-            image = get_image_by_id(moltin_access_token,
-                                    product.get('relationships').get('main_image').get('data').get('id'))
-            product['image_link'] = image.get('link').get('href')
-        category['products'] = products
+async def fetch_categories_products(moltin_access_token, categories):
+    async with async_moltin_helpers.get_moltin_client():
+        return await asyncio.gather(*[
+            async_moltin_helpers.call_with_retry(async_moltin_helpers.get_products_by_category_id,
+                                                 moltin_access_token, category.get('id'))
+            for category in categories
+        ])
+
+
+def get_categories_with_products(executor, db, moltin_access_token, image_hrefs, stage_timings):
+    with measure_stage(stage_timings, 'categories'):
+        categories = call_with_retry(get_all_categories, moltin_access_token, prefetch=True)
+    with measure_stage(stage_timings, 'products'):
+        categories_products = asyncio.run(fetch_categories_products(moltin_access_token, categories))
+        for category, products in zip(categories, categories_products):
+            category['products'] = products
+    with measure_stage(stage_timings, 'images'):
+        products = [product for category in categories for product in category['products']]
+        image_links = executor.map(
+            lambda product: get_image_link(db, moltin_access_token, product, image_hrefs),
+            products,
+        )
+        for product, image_link in zip(products, image_links):
+            product['image_link'] = image_link
     return categories
 
 
+def get_menu(executor, db, moltin_access_token, image_hrefs, categories, front_page_category_slug='main'):
+    for category in categories:
+        if category.get('slug') == front_page_category_slug:
+            return category
+    front_page_category = call_with_retry(get_category_by_slug, moltin_access_token, front_page_category_slug)[0]
+    front_page_products = call_with_retry(get_products_by_category_id, moltin_access_token,
+                                          front_page_category.get('id'))
+    image_links = executor.map(
+        lambda product: get_image_link(db, moltin_access_token, product, image_hrefs),
+        front_page_products,
+    )
+    for product, image_link in zip(front_page_products, image_links):
+        product['image_link'] = image_link
+    front_page_category['products'] = front_page_products
+    return front_page_category
+
+
 if __name__ == '__main__':
     env = Env()
     env.read_env()
     moltin_client_id = env('MOLTIN_CLIENT_ID')
     moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
     db = get_database_connection()
+    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
+    stage_timings = {}
+    started_at = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with measure_stage(stage_timings, 'image cache'):
+            image_hrefs = call_with_retry(warm_up_image_cache, db, moltin_access_token)
+        categories_with_products = get_categories_with_products(executor, db, moltin_access_token,
+                                                                image_hrefs, stage_timings)
+        with measure_stage(stage_timings, 'menu'):
+            menu = get_menu(executor, db, moltin_access_token, image_hrefs, categories_with_products)
+
+    if menu not in categories_with_products:
+        categories_with_products.append(menu)
+    with measure_stage(stage_timings, 'redis'):
+        changed_category_ids = save_categories(db, categories_with_products, menu.get('id'))
+    with measure_stage(stage_timings, 'product list'):
+        save_products(db, call_with_retry(get_all_products, moltin_access_token, prefetch=True))
 
-    menu = get_menu()
-    cached_menu = db.get('menu')
-    if cached_menu:
-        cached_menu = json.loads(cached_menu)
-    if cached_menu != menu:
-        db.set('menu', json.dumps(menu))
-
-    categories_with_products = get_categories_with_products()
-    cached_categories = db.get('categories')
-    if cached_categories:
-        cached_categories = json.loads(cached_categories)
-    if cached_categories != categories_with_products:
-        db.set('categories', json.dumps(categories_with_products))
+    print(f'Обновлено категорий: {len(changed_category_ids)}')
+    for stage, stage_seconds in stage_timings.items():
+        print(f'{stage}: {stage_seconds:.2f} с')
+    print(f'Всего: {time.perf_counter() - started_at:.2f} с')
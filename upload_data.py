@@ -1,14 +1,111 @@
 import json
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
+import requests
 from environs import Env
 from transliterate import translit
 
-from moltin_helpers import (create_flow, create_flow_field,
+from moltin_helpers import (call_with_retry, create_flow, create_flow_field,
                             create_main_image_relationship, create_pizzeria,
                             download_image, download_product,
-                            get_moltin_access_token)
+                            get_all_flow_fields, get_moltin_access_token,
+                            get_products_by_slug, is_transient_error,
+                            is_unsent_request_error, iter_entries, iter_flows,
+                            iter_images)
+from rate_limit_helpers import TokenBucket
+
+UPLOAD_WORKERS = 8
+UPLOAD_RATE = 20
+MAX_PENDING_PER_WORKER = 2
+CREATE_ATTEMPTS = 3
+CREATE_BACKOFF = 1
+
+
+class UploadCheckpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.sections = {}
+        if os.path.exists(path):
+            self.sections = get_file_contents(path)
+
+    def get(self, section, key):
+        with self._lock:
+            return self.sections.get(section, {}).get(key)
+
+    def save(self, section, key, value):
+        with self._lock:
+            self.sections.setdefault(section, {})[key] = value
+            temporary_path = f'{self.path}.tmp'
+            with open(temporary_path, 'w', encoding='UTF-8') as file:
+                json.dump(self.sections, file, ensure_ascii=False, indent=2)
+            os.replace(temporary_path, self.path)
+
+
+class Uploader:
+
+    def __init__(self, get_access_token, checkpoint, workers=UPLOAD_WORKERS, rate=UPLOAD_RATE):
+        self.get_access_token = get_access_token
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.rate_limiter = TokenBucket(rate, rate)
+        self._stats_lock = threading.Lock()
+        self.stats = {}
+
+    def call(self, function, *args, **kwargs):
+        self.rate_limiter.acquire()
+        self.count('moltin calls')
+        return call_with_retry(function, self.get_access_token(), *args, **kwargs)
+
+    def create(self, find_created, function, *args):
+        """
+        POST в Moltin не идемпотентен: после таймаута или ошибки 5xx запись могла быть создана,
+        поэтому запрос отправляется снова, только если find_created ее не нашел.
+        """
+        for attempt in range(CREATE_ATTEMPTS):
+            try:
+                return self.call(function, *args, is_retryable=is_unsent_request_error)
+            except requests.RequestException as error:
+                if attempt == CREATE_ATTEMPTS - 1 or not is_transient_error(error):
+                    raise
+            created = self.call(find_created)
+            if created is not None:
+                self.count('moltin recovered')
+                return created
+            time.sleep(CREATE_BACKOFF * 2 ** attempt)
+
+    def count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def run(self, kind, items, upload_item):
+        started_at = time.perf_counter()
+        pending_limit = threading.BoundedSemaphore(self.workers * MAX_PENDING_PER_WORKER)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                pending_limit.acquire()
+                future = executor.submit(self._upload, kind, upload_item, item)
+                future.add_done_callback(lambda _: pending_limit.release())
+                futures.append(future)
+            for future in as_completed(futures):
+                future.result()
+        self.count(f'{kind} seconds', time.perf_counter() - started_at)
+
+    def _upload(self, kind, upload_item, item):
+        try:
+            created = upload_item(self, item)
+        except Exception as error:
+            self.count(f'{kind} failed')
+            print(f'Не удалось загрузить {kind}: {error}')
+            return
+        self.count(f'{kind} created' if created else f'{kind} skipped')
 
 
 def get_file_contents(path):
@@ -18,40 +115,120 @@ def get_file_contents(path):
     return contents
 
 
-def upload_products(moltin_access_token, raw_products):
-    for raw_product in raw_products:
-        product_name = raw_product['name']
-        en_product_name = translit(product_name, language_code='ru', reversed=True).replace(' ', '_')
-        slug = re.sub('[^a-z]', '', en_product_name)
-        product = download_product(moltin_access_token, product_name, raw_product['description'],
-                                   raw_product['price'], slug)
-        image = download_image(moltin_access_token, raw_product['product_image']['url'])
-        create_main_image_relationship(moltin_access_token, product['id'], image['id'])
+def get_product_slug(product_name):
+    en_product_name = translit(product_name, language_code='ru', reversed=True).replace(' ', '_')
+    return re.sub('[^a-z]', '', en_product_name)
+
+
+def find_product(moltin_access_token, slug):
+    products = get_products_by_slug(moltin_access_token, slug)
+    return products[0] if products else None
+
+
+def find_image(moltin_access_token, image_url):
+    return next((image for image in iter_images(moltin_access_token)
+                 if (image.get('link') or {}).get('href') == image_url), None)
+
+
+def find_flow(moltin_access_token, slug):
+    return next((flow for flow in iter_flows(moltin_access_token) if flow.get('slug') == slug), None)
+
+
+def find_flow_field(moltin_access_token, flow_slug, field_slug):
+    return next((field for field in get_all_flow_fields(moltin_access_token, flow_slug)
+                 if field.get('slug') == field_slug), None)
+
+
+def find_pizzeria(moltin_access_token, alias):
+    entry = next((entry for entry in iter_entries(moltin_access_token, 'pizzeria') if entry.get('alias') == alias),
+                 None)
+    return {'data': entry} if entry else None
+
+
+def upload_product(uploader, raw_product):
+    slug = get_product_slug(raw_product['name'])
+    uploaded_product = uploader.checkpoint.get('products', slug) or {}
+    if uploaded_product.get('main_image'):
+        return False
+    if not uploaded_product.get('product_id'):
+        product = uploader.create(partial(find_product, slug=slug), download_product, raw_product['name'],
+                                  raw_product['description'], raw_product['price'], slug)
+        uploaded_product['product_id'] = product['id']
+        uploader.checkpoint.save('products', slug, uploaded_product)
+    if not uploaded_product.get('image_id'):
+        image_url = raw_product['product_image']['url']
+        image = uploader.create(partial(find_image, image_url=image_url), download_image, image_url)
+        uploaded_product['image_id'] = image['id']
+        uploader.checkpoint.save('products', slug, uploaded_product)
+    uploader.call(create_main_image_relationship, uploaded_product['product_id'], uploaded_product['image_id'])
+    uploaded_product['main_image'] = True
+    uploader.checkpoint.save('products', slug, uploaded_product)
+    return True
+
+
+def upload_products(uploader, raw_products):
+    uploader.run('products', raw_products, upload_product)
+
+
+def create_checkpointed_flow(uploader, name, slug, description, fields):
+    flow_id = uploader.checkpoint.get('flows', slug)
+    if not flow_id:
+        flow_id = uploader.create(partial(find_flow, slug=slug), create_flow, name, slug, description)['id']
+        uploader.checkpoint.save('flows', slug, flow_id)
+    for field_name, field_slug, field_type, field_description in fields:
+        field_key = f'{slug}.{field_slug}'
+        if uploader.checkpoint.get('flow_fields', field_key):
+            continue
+        uploader.create(partial(find_flow_field, flow_slug=slug, field_slug=field_slug), create_flow_field,
+                        flow_id, field_name, field_slug, field_type, field_description)
+        uploader.checkpoint.save('flow_fields', field_key, True)
+
+
+def create_pizzeria_flow(uploader):
+    create_checkpointed_flow(uploader, 'Pizzeria', 'pizzeria', 'Пиццерия', [
+        ('Address', 'address', 'string', 'Адреса'),
+        ('Alias', 'alias', 'string', 'Псевдоним'),
+        ('Longitude', 'longitude', 'float', 'Долгота'),
+        ('Latitude', 'latitude', 'float', 'Широта'),
+        ('Courier id', 'courier_id', 'string', 'ID доставщика'),
+    ])
+
+
+def upload_pizzeria(uploader, pizzeria):
+    if uploader.checkpoint.get('pizzerias', pizzeria['alias']):
+        return False
+    entry = uploader.create(partial(find_pizzeria, alias=pizzeria['alias']), create_pizzeria, 'pizzeria',
+                            'alias', pizzeria['alias'],
+                            'address', pizzeria['address']['full'],
+                            'longitude', float(pizzeria['coordinates']['lon']),
+                            'latitude', float(pizzeria['coordinates']['lat']),
+                            'courier_id', pizzeria['courier_id'])
+    uploader.checkpoint.save('pizzerias', pizzeria['alias'], entry['data']['id'])
+    return True
 
 
-def create_pizzeria_flow(moltin_access_token):
-    flow = create_flow(moltin_access_token, 'Pizzeria', 'pizzeria', 'Пиццерия')
-    create_flow_field(moltin_access_token, flow['id'], 'Address', 'address', 'string', 'Адреса')
-    create_flow_field(moltin_access_token, flow['id'], 'Alias', 'alias', 'string', 'Псевдоним')
-    create_flow_field(moltin_access_token, flow['id'], 'Longitude', 'longitude', 'float', 'Долгота')
-    create_flow_field(moltin_access_token, flow['id'], 'Latitude', 'latitude', 'float', 'Широта')
-    create_flow_field(moltin_access_token, flow['id'], 'Courier id', 'courier_id', 'string', 'ID доставщика')
+def upload_pizzerias(uploader, pizzerias):
+    uploader.run('pizzerias', pizzerias, upload_pizzeria)
 
 
-def upload_pizzerias(moltin_access_token, pizzerias):
-    for pizzeria in pizzerias:
-        create_pizzeria(moltin_access_token, 'pizzeria',
-                        'alias', pizzeria['alias'],
-                        'address', pizzeria['address']['full'],
-                        'longitude', float(pizzeria['coordinates']['lon']),
-                        'latitude', float(pizzeria['coordinates']['lat']),
-                        'courier_id', pizzeria['courier_id'])
+def create_customer_address_flow(uploader):
+    create_checkpointed_flow(uploader, 'Customer Address', 'customer_address', 'Адрес заказчика', [
+        ('Latitude', 'latitude', 'float', 'Широта'),
+        ('Longitude', 'longitude', 'float', 'Долгота'),
+    ])
 
 
-def create_customer_address_flow(moltin_access_token):
-    customer_address_flow = create_flow(moltin_access_token, 'Customer Address', 'customer_address', 'Адрес заказчика')
-    create_flow_field(moltin_access_token, customer_address_flow['id'], 'Latitude', 'latitude', 'float', 'Широта')
-    create_flow_field(moltin_access_token, customer_address_flow['id'], 'Longitude', 'longitude', 'float', 'Долгота')
+def print_summary(stats, elapsed_seconds):
+    for kind in ('products', 'pizzerias'):
+        created = stats.get(f'{kind} created', 0)
+        kind_seconds = stats.get(f'{kind} seconds', 0)
+        throughput = created / kind_seconds if kind_seconds else 0
+        print(f'{kind}: создано {created}, пропущено {stats.get(f"{kind} skipped", 0)}, '
+              f'ошибок {stats.get(f"{kind} failed", 0)}, {throughput:.1f} в секунду')
+    moltin_calls = stats.get('moltin calls', 0)
+    print(f'Запросов к Moltin: {moltin_calls}, {moltin_calls / elapsed_seconds:.1f} в секунду, '
+          f'найдено уже созданных после сбоя: {stats.get("moltin recovered", 0)}')
+    print(f'Всего: {elapsed_seconds:.2f} с')
 
 
 def main():
@@ -59,17 +236,23 @@ def main():
     env.read_env()
     products_path = env('PRODUCTS_PATH', 'products.json')
     pizzerias_path = env('PIZZERIAS_PATH', 'pizzerias.json')
+    checkpoint_path = env('UPLOAD_CHECKPOINT_PATH', 'upload_checkpoint.json')
+    upload_workers = env.int('UPLOAD_WORKERS', UPLOAD_WORKERS)
+    upload_rate = env.float('UPLOAD_RATE', UPLOAD_RATE)
     moltin_client_id = env('MOLTIN_CLIENT_ID')
     moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
-    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
+    get_access_token = partial(get_moltin_access_token, moltin_client_id, moltin_client_secret)
 
     products = get_file_contents(os.path.join(products_path))
     pizzerias = get_file_contents(os.path.join(pizzerias_path))
 
-    upload_products(moltin_access_token, products)
-    create_pizzeria_flow(moltin_access_token)
-    upload_pizzerias(moltin_access_token, pizzerias)
-    create_customer_address_flow(moltin_access_token)
+    started_at = time.perf_counter()
+    uploader = Uploader(get_access_token, UploadCheckpoint(checkpoint_path), upload_workers, upload_rate)
+    upload_products(uploader, products)
+    create_pizzeria_flow(uploader)
+    upload_pizzerias(uploader, pizzerias)
+    create_customer_address_flow(uploader)
+    print_summary(uploader.stats, time.perf_counter() - started_at)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,32 @@
+import logging
+
+import telegram
+from environs import Env
+
+from catalog_helpers import get_products
+from moltin_helpers import get_moltin_access_token
+from photo_helpers import warm_up_product_photos
+from state_store import get_database_connection
+
+logger = logging.getLogger('warm_up_photos')
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    env = Env()
+    env.read_env()
+    tg_token = env('TG_TOKEN')
+    service_chat_id = env('TG_SERVICE_CHAT_ID', env('TG_CHAT_ID'))
+    moltin_client_id = env('MOLTIN_CLIENT_ID')
+    moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
+    moltin_access_token = get_moltin_access_token(moltin_client_id, moltin_client_secret)
+    db = get_database_connection()
+    bot = telegram.Bot(token=tg_token)
+
+    products = get_products(db, moltin_access_token)
+    uploaded_photos = warm_up_product_photos(bot, db, moltin_access_token, service_chat_id, products)
+    logger.info(f'Загружено фотографий в Telegram: {uploaded_photos}')
+
+
+if __name__ == '__main__':
+    main()